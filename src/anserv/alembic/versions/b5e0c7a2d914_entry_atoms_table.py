@@ -0,0 +1,41 @@
+"""entry_atoms_table
+
+Revision ID: b5e0c7a2d914
+Revises: 0002c4713f6f
+Create Date: 2026-10-18 18:12:04.561302
+"""
+import pyarrow as pa
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b5e0c7a2d914'
+down_revision = '0002c4713f6f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('entry', sa.Column('atoms_table', sa.Boolean(), server_default='true', nullable=False))
+
+    # Entries with a blob have all of their atoms in the table only if numbers of atoms match
+    conn = op.get_bind()
+    rows = conn.execute(
+        sa.text(
+            'SELECT entry.id, count(atom.entry_id) FROM entry LEFT JOIN atom ON atom.entry_id = entry.id '
+            'WHERE entry.atoms_blob IS NOT NULL GROUP BY entry.id'
+        )
+    ).all()
+    for entry_id, count in rows:  # one entry at a time, so only a single blob is kept in memory
+        if count:
+            blob = conn.execute(
+                sa.text('SELECT atoms_blob FROM entry WHERE id = :entry_id'), {'entry_id': entry_id}
+            ).scalar_one()
+            if pa.ipc.open_file(pa.BufferReader(blob)).read_all().num_rows == count:
+                continue
+        conn.execute(sa.text('UPDATE entry SET atoms_table = false WHERE id = :entry_id'), {'entry_id': entry_id})
+
+
+def downgrade() -> None:
+    op.drop_column('entry', 'atoms_table')
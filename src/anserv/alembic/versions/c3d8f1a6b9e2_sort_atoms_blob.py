@@ -0,0 +1,43 @@
+"""sort_atoms_blob
+
+Revision ID: c3d8f1a6b9e2
+Revises: e7b2c9d4f5a8
+Create Date: 2026-10-18 16:05:37.284910
+"""
+import pyarrow as pa
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c3d8f1a6b9e2'
+down_revision = 'e7b2c9d4f5a8'
+branch_labels = None
+depends_on = None
+
+# Frozen copy of the canonical order of atoms at the time of the migration, see `api.services.ATOMS_ORDER`
+ATOMS_ORDER = [('date', 'ascending'), ('team', 'ascending')]
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    entry_ids = conn.execute(sa.text('SELECT id FROM entry WHERE atoms_blob IS NOT NULL')).scalars().all()
+    for entry_id in entry_ids:  # one entry at a time, so only a single one is kept in memory
+        blob = conn.execute(
+            sa.text('SELECT atoms_blob FROM entry WHERE id = :entry_id'), {'entry_id': entry_id}
+        ).scalar_one()
+        table = pa.ipc.open_file(pa.BufferReader(blob)).read_all()
+
+        sink = pa.BufferOutputStream()
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+        with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+            writer.write_table(table.sort_by(ATOMS_ORDER))
+
+        conn.execute(
+            sa.text('UPDATE entry SET atoms_blob = :blob WHERE id = :entry_id'),
+            {'blob': sink.getvalue().to_pybytes(), 'entry_id': entry_id},
+        )
+
+
+def downgrade() -> None:
+    pass  # any order of atoms is valid for the previous revision
@@ -1,5 +1,7 @@
 import datetime
-from typing import Any, Dict, Literal, Optional, Union
+import hashlib
+import time
+from typing import Any, Dict, Literal, Optional, Tuple, Union
 
 from fastapi import Depends, status
 from fastapi.exceptions import HTTPException
@@ -7,11 +9,22 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlalchemy import select
+from sqlalchemy import event, inspect, select
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
-
-from conf import AUTH_ALGORITHM, AUTH_SECRET_KEY, AUTH_TOKEN_EXPIRE_MINUTES
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from starlette.concurrency import run_in_threadpool
+
+from api.cache import LRUCache
+from api.executors import ExecutorBusy, password_executor
+from conf import (
+    AUTH_ALGORITHM,
+    AUTH_SECRET_KEY,
+    AUTH_TOKEN_CACHE_SIZE,
+    AUTH_TOKEN_EXPIRE_MINUTES,
+    AUTH_USER_CACHE_SIZE,
+    AUTH_USER_CACHE_TTL,
+)
 from db.orm import UserOrm
 from db.utils import get_db
 
@@ -25,11 +38,12 @@ class Token(BaseModel):
     token_type: Literal['bearer']
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+def verify_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Whether the password matches, along with its new hash if the current one is deprecated"""
     try:
-        return pwd_context.verify(plain_password, hashed_password)
+        return pwd_context.verify_and_update(plain_password, hashed_password)
     except ValueError:
-        return False
+        return False, None
 
 
 def get_password_hash(password: str) -> str:
@@ -43,10 +57,14 @@ async def authenticate_user(db: AsyncSession, username: str, password: str) -> O
     except NoResultFound:
         return None
 
-    if not verify_password(password, user.hashed_password):
+    assert isinstance(user, UserOrm)
+    verified, new_hash = await password_executor.run(verify_password, password, user.hashed_password)
+    if not verified:
         return None
 
-    assert isinstance(user, UserOrm)
+    if new_hash is not None:
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
 
@@ -61,26 +79,78 @@ def create_access_token(data: Dict[str, Any], expires_delta: Union[datetime.time
     return encoded_jwt
 
 
-async def get_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> UserOrm:
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail='Could not validate credentials',
-        headers={'WWW-Authenticate': 'Bearer'},
-    )
+def _token_ttl(payload: Dict[str, Any]) -> float:
+    """Seconds until the token expires, tokens without `exp` never do"""
+    exp = payload.get('exp')
+    return float('inf') if exp is None else exp - time.time()
+
+
+# Payloads of tokens with verified signatures and claims, by digests of tokens
+token_cache: LRUCache[bytes, Dict[str, Any]] = LRUCache('auth_token', AUTH_TOKEN_CACHE_SIZE, ttl=_token_ttl)
+
+
+# Ids and names of users by their names, so authenticated requests don't query the database every time
+user_cache: LRUCache[str, Dict[str, Any]] = LRUCache('auth_user', AUTH_USER_CACHE_SIZE, ttl=AUTH_USER_CACHE_TTL)
+
+
+def invalidate_user(name: str) -> None:
+    """Must be called once the user is deleted or changed by means other than the ORM of this process"""
+    user_cache.invalidate(name)
+
+
+@event.listens_for(UserOrm, 'after_update')
+@event.listens_for(UserOrm, 'after_delete')
+def _collect_changed_user(mapper: Any, connection: Any, target: UserOrm) -> None:
+    session = object_session(target)
+    assert session is not None  # flushed by it
+    # previous names of renamed users too
+    session.info.setdefault('changed_users', set()).update([target.name, *inspect(target).attrs.name.history.deleted])
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _invalidate_changed_users(session: Session) -> None:
+    # Not at flush: until the commit, other sessions would load and cache the previous state again
+    for name in session.info.pop('changed_users', ()):
+        invalidate_user(name)
+
+
+async def _load_user_columns(db: AsyncSession, username: str) -> Dict[str, Any]:
+    res = await db.execute(select(UserOrm.id, UserOrm.name).where(UserOrm.name == username))
+    return dict(res.one()._mapping)  # NoResultFound isn't cached, users might be created later
+
+
+async def _user_for_token(db: AsyncSession, token: str) -> Optional[UserOrm]:
     try:
-        payload = jwt.decode(token, AUTH_SECRET_KEY, algorithms=[AUTH_ALGORITHM])
-        username = payload.get('sub')
-        if username is None:
-            raise credentials_exception
+        # Decoded in the thread pool once per token, JWTError isn't cached
+        payload = await token_cache.get_or_load(
+            hashlib.sha256(token.encode()).digest(),
+            lambda: run_in_threadpool(jwt.decode, token, AUTH_SECRET_KEY, algorithms=[AUTH_ALGORITHM]),
+        )
     except JWTError:
-        raise credentials_exception
+        return None
+    username = payload.get('sub')
+    if username is None:
+        return None
 
-    res = await db.execute(select(UserOrm).where(UserOrm.name == username))
     try:
-        user = res.one()[0]
+        columns = await user_cache.get_or_load(username, lambda: _load_user_columns(db, username))
     except NoResultFound:
-        raise credentials_exception
-    assert isinstance(user, UserOrm)
+        return None
+    # A user of the database, which isn't bound to the session, so other columns and relationships can't be loaded
+    user = UserOrm(**columns)
+    make_transient_to_detached(user)
+    return user
+
+
+async def get_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> UserOrm:
+    user = await _user_for_token(db, token)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail='Could not validate credentials',
+            headers={'WWW-Authenticate': 'Bearer'},
+        )
     return user
 
 
@@ -89,26 +159,14 @@ async def get_user_or_none(
 ) -> Optional[UserOrm]:
     if not token:
         return None
-
-    try:
-        payload = jwt.decode(token, AUTH_SECRET_KEY, algorithms=[AUTH_ALGORITHM])
-        username = payload.get('sub')
-        if username is None:
-            return None
-    except JWTError:
-        return None
-
-    res = await db.execute(select(UserOrm).where(UserOrm.name == username))
-    try:
-        user = res.one()[0]
-    except NoResultFound:
-        return None
-    assert isinstance(user, UserOrm)
-    return user
+    return await _user_for_token(db, token)
 
 
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)) -> Token:
-    user = await authenticate_user(db, form_data.username, form_data.password)
+    try:
+        user = await authenticate_user(db, form_data.username, form_data.password)
+    except ExecutorBusy:
+        raise HTTPException(503, detail='Too many pending logins', headers={'Retry-After': '1'})
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,227 @@
+import asyncio
+import contextlib
+import enum
+import itertools
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Optional, Set, Tuple, TypeVar, Union, cast
+
+from api import metrics
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class CacheBackends(str, enum.Enum):
+    MEMORY = 'memory'
+    DISK = 'disk'  # for larger values, only their sizes are kept in memory
+
+
+class LRUCache(Generic[K, V]):
+    """Process-local cache bounded by the total size of values, least recently used ones are evicted first.
+
+    Sizes are given by `sizeof`, in bytes, without it the cache is bounded by the number of values.
+
+    Concurrent misses of the same key are coalesced: the first caller loads the value, the rest await it.
+    Values are shared between callers, so they must not be modified in place.
+    With `ttl`, values are loaded again once they are older than `ttl` seconds, it might be a function of the value.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_size: int,
+        sizeof: Optional[Callable[[V], int]] = None,
+        ttl: Union[float, Callable[[V], float], None] = None,
+    ):
+        self.name = name
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.size = 0
+        self._sizes: OrderedDict[K, int] = OrderedDict()
+        self._values: Dict[K, Any] = {}  # handles of stored values
+        self._deadlines: Dict[K, float] = {}
+        self._pending: Dict[K, asyncio.Future[V]] = {}
+        self._lookups = 0
+        self._hits = 0
+
+        if sizeof is not None:
+            metrics.register_gauge(f'cache_{name}_bytes', lambda: self.size)
+        metrics.register_gauge(f'cache_{name}_items', lambda: len(self._sizes))
+        metrics.register_gauge(f'cache_{name}_hit_ratio', lambda: self._hits / self._lookups if self._lookups else 0)
+
+    async def get_or_load(self, key: K, load: Callable[[], Awaitable[V]]) -> V:
+        self._lookups += 1
+        while True:
+            if key in self:
+                handle = self._values[key]
+                self._sizes.move_to_end(key)
+                try:
+                    value = await self._load(handle)
+                except KeyError:  # the stored value is gone, loaded again as a miss
+                    if self._values.get(key) is handle:
+                        self._remove(key)
+                    continue
+                self._hits += 1
+                metrics.inc(f'cache_{self.name}_hits')
+                return value
+
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+
+            metrics.inc(f'cache_{self.name}_coalesced')
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():  # the caller itself is cancelled
+                    raise
+                # the loading caller was cancelled, trying again
+
+        metrics.inc(f'cache_{self.name}_misses')
+        future: asyncio.Future[V] = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await load()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # marks it retrieved, there might be no other callers awaiting it
+            raise
+        else:
+            future.set_result(value)
+            if self._pending.get(key) is future:  # otherwise invalidated while loading, might be stale already
+                await self._put(key, value, future)
+            return value
+        finally:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def __contains__(self, key: K) -> bool:
+        if key not in self._sizes:
+            return False
+        deadline = self._deadlines.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._remove(key)
+            metrics.inc(f'cache_{self.name}_expirations')
+            return False
+        return True
+
+    def invalidate(self, key: K) -> None:
+        self._pending.pop(key, None)
+        if key in self._sizes:
+            self._remove(key)
+
+    def invalidate_where(self, predicate: Callable[[K], bool]) -> None:
+        for key in [key for key in [*self._sizes, *self._pending] if predicate(key)]:
+            self.invalidate(key)
+
+    def clear(self) -> None:
+        for key in list(self._sizes):
+            self.invalidate(key)
+        self._pending.clear()
+
+    async def _put(self, key: K, value: V, future: 'asyncio.Future[V]') -> None:
+        size = 1 if self.sizeof is None else self.sizeof(value)
+        if size > self.max_size:
+            return
+
+        handle = await self._store(key, value)
+        if self._pending.get(key) is not future:  # invalidated while storing
+            self._discard(handle)
+            return
+        if key in self._sizes:
+            self._remove(key)
+        self._values[key] = handle
+        self._sizes[key] = size
+        self.size += size
+        if self.ttl is not None:
+            self._deadlines[key] = time.monotonic() + (self.ttl(value) if callable(self.ttl) else self.ttl)
+        while self.size > self.max_size:
+            self._remove(next(iter(self._sizes)))
+            metrics.inc(f'cache_{self.name}_evictions')
+
+    def _remove(self, key: K) -> None:
+        self.size -= self._sizes.pop(key)
+        self._deadlines.pop(key, None)
+        self._discard(self._values.pop(key))
+
+    # Storage of values, overridden by subclasses. A handle is whatever locates a stored value.
+
+    async def _store(self, key: K, value: V) -> Any:
+        return value
+
+    async def _load(self, handle: Any) -> V:
+        """Raises `KeyError` if the stored value is gone"""
+        return cast(V, handle)
+
+    def _discard(self, handle: Any) -> None:
+        pass
+
+
+class DiskCache(LRUCache[Tuple[str, ...], bytes]):
+    """Stores values as files in a private temporary directory, key parts are path segments.
+
+    Files are read and written in the default thread pool, since values might be large. Every stored value gets
+    a file of its own, so removing a previous value of the same key never races with writing the next one.
+    A file removed by someone else, e.g. a cleaner of temporary files, is a miss.
+    """
+
+    def __init__(self, name: str, max_size: int, directory: str):
+        super().__init__(name, max_size, len)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix=f'{name}-', dir=directory)
+        self._serial = itertools.count()
+        self._removing: Set['asyncio.Future[None]'] = set()
+
+    async def flush(self) -> None:
+        """Waits until files of removed values are removed"""
+        if self._removing:
+            await asyncio.wait(self._removing)
+
+    def close(self) -> None:
+        self.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    async def _store(self, key: Tuple[str, ...], value: bytes) -> str:
+        path = f'{os.path.join(self.directory, *key)}.{next(self._serial)}'
+        await asyncio.get_running_loop().run_in_executor(None, _write_file, path, value)
+        return path
+
+    async def _load(self, handle: str) -> bytes:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, _read_file, handle)
+        except FileNotFoundError:
+            raise KeyError(handle)
+
+    def _discard(self, handle: str) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:  # closed outside of the event loop
+            _remove_file(handle)
+        else:
+            future = loop.run_in_executor(None, _remove_file, handle)
+            self._removing.add(future)
+            future.add_done_callback(self._removing.discard)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _write_file(path: str, value: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(value)
+
+
+def _remove_file(path: str) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
@@ -0,0 +1,102 @@
+import asyncio
+import concurrent.futures
+import enum
+import functools
+import multiprocessing
+import time
+from typing import Any, Callable, Optional, Tuple, TypeVar
+
+from api import metrics
+from conf import (
+    INGEST_EXECUTOR_WORKERS,
+    PASSWORD_EXECUTOR_QUEUE_SIZE,
+    PASSWORD_EXECUTOR_WORKERS,
+    VIS_EXECUTOR_TYPE,
+    VIS_EXECUTOR_WORKERS,
+)
+
+T = TypeVar('T')
+
+
+class ExecutorTypes(str, enum.Enum):
+    THREAD = 'thread'  # for code releasing the GIL, i.e. most of Arrow
+    PROCESS = 'process'  # callables, arguments and results have to be picklable
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+def _timed_call(submitted: float, func: Callable[..., T], *args: Any, **kwargs: Any) -> Tuple[float, T]:
+    """Result of the call along with seconds it waited for a worker, wall clock is the same for processes"""
+    waited = time.time() - submitted
+    return waited, func(*args, **kwargs)
+
+
+class PoolExecutor:
+    """Runs CPU bound calls outside of the event loop, so other requests are served meanwhile.
+
+    The pool is created on first use and is recreated after `shutdown`.
+    With `max_queue`, calls are rejected with `ExecutorBusy` rather than wait behind that many others.
+    """
+
+    def __init__(self, name: str, executor_type: ExecutorTypes, workers: int, max_queue: Optional[int] = None):
+        self.name = name
+        self.executor_type = executor_type
+        self.workers = workers
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._pool: Optional[concurrent.futures.Executor] = None
+
+        metrics.register_gauge(f'executor_{name}_in_flight', lambda: self.in_flight)
+        metrics.register_gauge(f'executor_{name}_queue_depth', lambda: self.queue_depth)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of calls waiting for a free worker"""
+        return max(self.in_flight - self.workers, 0)
+
+    @property
+    def pool(self) -> concurrent.futures.Executor:
+        if self._pool is None:
+            if self.executor_type == ExecutorTypes.PROCESS:
+                # spawn, since forking a process with a running event loop and open connections is not safe
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            else:
+                self._pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix=self.name)
+        return self._pool
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        if self.max_queue is not None and self.queue_depth >= self.max_queue:
+            metrics.inc(f'executor_{self.name}_rejected')
+            raise ExecutorBusy()
+
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        try:
+            waited, result = await loop.run_in_executor(
+                self.pool, functools.partial(_timed_call, time.time(), func, *args, **kwargs)
+            )
+        finally:
+            self.in_flight -= 1
+        metrics.inc(f'executor_{self.name}_calls')
+        metrics.inc(f'executor_{self.name}_queue_seconds', waited)  # divided by calls, it's the average wait
+        return result
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+# Parsing of uploaded files, always threads: file objects are not picklable and pyarrow releases the GIL
+ingest_executor = PoolExecutor('ingest', ExecutorTypes.THREAD, INGEST_EXECUTOR_WORKERS)
+# Calculation of visualizations, pandas holds the GIL for a good part of it, so processes might be preferred
+vis_executor = PoolExecutor('vis', ExecutorTypes(VIS_EXECUTOR_TYPE), VIS_EXECUTOR_WORKERS)
+# Hashing and verification of passwords, bcrypt is slow by design and releases the GIL.
+# Login bursts are rejected rather than queued for long, each call takes a fraction of a second.
+password_executor = PoolExecutor(
+    'password', ExecutorTypes.THREAD, PASSWORD_EXECUTOR_WORKERS, max_queue=PASSWORD_EXECUTOR_QUEUE_SIZE
+)
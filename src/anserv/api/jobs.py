@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+from api import metrics
+from api.executors import ingest_executor
+from api.models import EntrySummary
+from api.services import InvalidFile, insert_atoms, parse_uploaded_file
+from conf import CSV_BLOCK_SIZE, INGEST_JOBS_HISTORY, INGEST_QUEUE_SIZE, INGEST_WORKERS
+from const import FileFormats
+from db.utils import async_session
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatus(str, enum.Enum):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class IngestJob(BaseModel):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4)
+
+    status: JobStatus = JobStatus.PENDING
+    rows_parsed: int = 0
+    rows_inserted: int = 0
+    error: Optional[str] = None
+    result: Optional[EntrySummary] = None
+
+    _user_id: uuid.UUID = PrivateAttr()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    def add_parsed(self, rows: int) -> None:
+        self.rows_parsed += rows
+
+    def add_inserted(self, rows: int) -> None:
+        self.rows_inserted += rows
+
+
+class QueueFull(Exception):
+    pass
+
+
+SHUTDOWN_ERROR = 'Server is shutting down'
+
+
+def spool_upload(fp: BinaryIO) -> str:
+    """Copies uploaded file to a named temporary file, which outlives the request"""
+    with tempfile.NamedTemporaryFile(mode='wb', prefix='upload-', delete=False) as tmp:
+        shutil.copyfileobj(fp, tmp, CSV_BLOCK_SIZE)
+    return tmp.name
+
+
+class IngestQueue:
+    """Bounded queue of uploaded files processed by a pool of worker tasks.
+
+    Jobs live in the memory of the current process, so status is available only from the same worker.
+    """
+
+    def __init__(self, workers: int, maxsize: int, history: int):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.history = history
+        self.jobs: Dict[uuid.UUID, IngestJob] = {}
+        self._queue: Optional[asyncio.Queue[Tuple[IngestJob, str, Optional[str], FileFormats]]] = None
+        self._tasks: List[asyncio.Task[None]] = []
+
+        metrics.register_gauge('ingest_jobs_pending', lambda: self._queue.qsize() if self._queue else 0)
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        # dropping files of jobs that never started, running ones are failed and cleaned up by their workers
+        while self._queue is not None and not self._queue.empty():
+            job, path, _, _ = self._queue.get_nowait()
+            job.status = JobStatus.FAILED
+            job.error = SHUTDOWN_ERROR
+            os.unlink(path)
+
+    def is_full(self) -> bool:
+        assert self._queue is not None, 'Queue is not started'
+        return self._queue.full()
+
+    def submit(
+        self,
+        user_id: uuid.UUID,
+        path: str,
+        content_hash: Optional[str] = None,
+        file_format: FileFormats = FileFormats.CSV,
+    ) -> IngestJob:
+        """Enqueues an uploaded file, the job takes ownership of the file and removes it when done"""
+        assert self._queue is not None, 'Queue is not started'
+        job = IngestJob()
+        job._user_id = user_id
+        try:
+            self._queue.put_nowait((job, path, content_hash, file_format))
+        except asyncio.QueueFull:
+            raise QueueFull()
+
+        self.jobs[job.id] = job
+        self._prune()
+        return job
+
+    def get(self, job_id: uuid.UUID, user_id: uuid.UUID) -> Optional[IngestJob]:
+        job = self.jobs.get(job_id)
+        if job is None or job._user_id != user_id:
+            return None
+        return job
+
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+        for job_id in finished[: max(len(finished) - self.history, 0)]:  # dicts are ordered, oldest go first
+            del self.jobs[job_id]
+
+    async def _worker(self) -> None:
+        assert self._queue is not None
+        while True:
+            job, path, content_hash, file_format = await self._queue.get()
+            try:
+                await self._process(job, path, content_hash, file_format)
+            finally:
+                os.unlink(path)
+                self._queue.task_done()
+
+    async def _process(self, job: IngestJob, path: str, content_hash: Optional[str], file_format: FileFormats) -> None:
+        job.status = JobStatus.RUNNING
+        try:
+            with open(path, 'rb') as fp:
+                entry, table = await ingest_executor.run(
+                    parse_uploaded_file, fp, job._user_id, job.add_parsed, file_format
+                )
+            entry.content_hash = content_hash
+
+            async with async_session() as db:
+                db.add(entry)
+                await db.flush()
+                await insert_atoms(db, entry.id, table, job.add_inserted)
+                await db.commit()
+        except asyncio.CancelledError:
+            job.status = JobStatus.FAILED
+            job.error = SHUTDOWN_ERROR
+            raise
+        except InvalidFile as e:
+            job.status = JobStatus.FAILED
+            job.error = str(e) or 'Invalid file'
+        except Exception:
+            logger.exception('Ingest job %s failed', job.id)
+            job.status = JobStatus.FAILED
+            job.error = 'Internal error'
+        else:
+            job.result = EntrySummary.from_orm(entry)
+            job.status = JobStatus.DONE
+
+
+ingest_queue = IngestQueue(workers=INGEST_WORKERS, maxsize=INGEST_QUEUE_SIZE, history=INGEST_JOBS_HISTORY)
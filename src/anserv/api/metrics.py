@@ -0,0 +1,25 @@
+"""In-process metrics, exposed as JSON by `GET /metrics/`.
+
+Values are local to the current process, every uvicorn worker reports its own.
+"""
+from collections import defaultdict
+from typing import Callable, DefaultDict, Dict
+
+_counters: DefaultDict[str, float] = defaultdict(float)
+_gauges: Dict[str, Callable[[], float]] = {}
+
+
+def inc(name: str, value: float = 1) -> None:
+    _counters[name] += value
+
+
+def register_gauge(name: str, func: Callable[[], float]) -> None:
+    """Gauge value is calculated by `func` on each snapshot"""
+    _gauges[name] = func
+
+
+def snapshot() -> Dict[str, float]:
+    out = dict(_counters)
+    for name, func in _gauges.items():
+        out[name] = func()
+    return dict(sorted(out.items()))
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 import datetime
 import uuid
-from typing import List
+from typing import Any, Dict, List
 
 from pydantic import BaseModel, Field
 
@@ -80,6 +80,15 @@ class VisualizationWithData(Visualization):
         orm_mode = False
 
 
+class VisualizationWithColumns(Visualization):
+    columns: Dict[str, List[Any]] = Field(description='Values of each field of output entries')
+    dictionaries: Dict[str, List[Any]] = Field(description='Values of dictionary encoded columns, indexed by codes')
+
+    class Config:
+        frozen = True
+        orm_mode = False
+
+
 for field_name in SUMMARY_FIELDS:
     for suffix in SUMMARY_FUNCTIONS.keys():
         assert f'{field_name}_{suffix}' in EntrySummary.__fields__
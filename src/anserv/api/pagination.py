@@ -0,0 +1,100 @@
+import base64
+import datetime
+import json
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Type, Union
+
+from fastapi.exceptions import HTTPException
+from pydantic import BaseModel, Field, create_model
+from sqlalchemy import Row, Select, literal, tuple_
+from sqlalchemy.orm import InstrumentedAttribute
+
+from db.orm import EntryOrm, VisualizationOrm
+
+# Listed rows have a creation time and an id, listings are ordered by both from the newest
+ListedOrm = Union[Type[EntryOrm], Type[VisualizationOrm]]
+
+PAGE_RESPONSES: Dict[Union[int, str], Dict[str, Any]] = {
+    200: {
+        'description': 'Items of the page, only the requested fields of them with `fields`',
+        'headers': {
+            'Link': {
+                'description': 'URL of the next page, as `<url>; rel="next"`, missing on the last page',
+                'schema': {'type': 'string'},
+            },
+        },
+    },
+}
+
+
+def encode_cursor(dt: datetime.datetime, id: uuid.UUID) -> str:
+    """Opaque cursor of the page following the row"""
+    return base64.urlsafe_b64encode(json.dumps([dt.isoformat(), str(id)]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, uuid.UUID]:
+    try:
+        dt, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(dt), uuid.UUID(id)
+    except (ValueError, TypeError):
+        raise HTTPException(422, detail='Invalid cursor')
+
+
+def parse_fields(fields: Optional[str], model: Type[BaseModel]) -> Optional[List[str]]:
+    """Comma separated fields of the model in the order of the model, None if all of them are requested"""
+    if fields is None:
+        return None
+    requested = {name.strip() for name in fields.split(',')} - {''}
+    unknown = requested - model.__fields__.keys()
+    if not requested or unknown:
+        raise HTTPException(422, detail=f'Unknown fields: {", ".join(sorted(unknown))}' if unknown else 'No fields')
+    return [name for name in model.__fields__ if name in requested]
+
+
+def page_model(model: Type[BaseModel]) -> Any:
+    """Schema of a page of listed items, fields are optional, since only the requested ones are returned.
+
+    It documents the response only. Full items are validated by the model itself when they are built,
+    projected values are returned as they are in the database, see `project`.
+    """
+    fields: Dict[str, Any] = {
+        name: (Optional[field.outer_type_], Field(None, description=field.field_info.description))
+        for name, field in model.__fields__.items()
+    }
+    sparse: Any = create_model(f'Sparse{model.__name__}', **fields)
+    return List[sparse]
+
+
+def page_columns(orm: ListedOrm, fields: Sequence[str]) -> List[InstrumentedAttribute[Any]]:
+    """Columns of the fields, along with the ones the cursor is made of"""
+    names = [*fields, *(name for name in ('dt', 'id') if name not in fields)]
+    return [getattr(orm, name) for name in names]
+
+
+def paginate(stmt: Select[Any], orm: ListedOrm, cursor: Optional[str], limit: Optional[int]) -> Select[Any]:
+    """Rows of the page following the cursor, the first page without one.
+
+    A row more than the limit is selected, it tells if there's a next page, see `split_page`.
+    The order matches the `(user_id, dt, id)` index of entries and the `(dt, id)` index of visualizations.
+    """
+    stmt = stmt.order_by(orm.dt.desc(), orm.id.desc())
+    if cursor is not None:
+        dt, id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(orm.dt, orm.id) < tuple_(literal(dt), literal(id)))
+    if limit is not None:
+        stmt = stmt.limit(limit + 1)
+    return stmt
+
+
+def split_page(rows: Sequence[Row[Any]], limit: Optional[int]) -> Tuple[Sequence[Row[Any]], Optional[str]]:
+    """Rows of the page selected by `paginate` along with the cursor of the next page, if there is one"""
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]._mapping
+    return rows, encode_cursor(last['dt'], last['id'])
+
+
+def project(rows: Sequence[Row[Any]], fields: Sequence[str]) -> List[Dict[str, Any]]:
+    """Values of the fields as they are in the database, without validating them by a model"""
+    return [{name: row._mapping[name] for name in fields} for row in rows]
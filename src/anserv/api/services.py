@@ -1,93 +1,878 @@
+import hashlib
+import io
+import itertools
+import json
+import os
 import uuid
-from typing import TYPE_CHECKING, Any, BinaryIO, Dict, List, Union
+from typing import (
+    IO,
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
 
+import numpy as np
+import numpy.typing as npt
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from pyarrow import csv
-from sqlalchemy import select
+from sqlalchemy import ColumnElement, Integer, Select, String, and_, bindparam, column, delete, func, select
+from sqlalchemy import table as sa_table
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import Session
 
-from const import PA_COLUMN_TYPES, SUMMARY_FIELDS, SUMMARY_FUNCTIONS, Columns
-from db.orm import AtomOrm, EntryOrm
+from api.cache import CacheBackends, DiskCache, LRUCache
+from api.executors import ingest_executor
+from api.stats import Histogram
+from conf import (
+    ATOMS_COPY_BATCH_SIZE,
+    ATOMS_TABLE,
+    CSV_BLOCK_SIZE,
+    ENTRY_CACHE_MAX_BYTES,
+    VIS_CACHE_BACKEND,
+    VIS_CACHE_DIR,
+    VIS_CACHE_MAX_BYTES,
+    VIS_SQL_AGGREGATION,
+)
+from const import MT2COL, PA_COLUMN_TYPES, SUMMARY_FIELDS, Columns, FileFormats, VisDataFormats
+from db.orm import AtomOrm, EntryOrm, RollupOrm
+from vis.buckets import ROLLUP_RESOLUTIONS, bucket_labels
+from vis.filters import AnyDataFilter, compile_filters
+from vis.vis_types import Aggregation, AnyVisType
 
-if TYPE_CHECKING:
-    from sqlalchemy.orm.attributes import InstrumentedAttribute
+# Called with a number of processed rows after each processed chunk
+ProgressCallback = Callable[[int], None]
 
 
 class InvalidFile(Exception):
     pass
 
 
-def parse_uploaded_file(fp: Union[str, BinaryIO], user_id: uuid.UUID) -> EntryOrm:
-    opts = pa.csv.ConvertOptions(column_types=PA_COLUMN_TYPES)
+FORMAT_SIGNATURES = {  # magic bytes at the start of a file
+    b'\x1f\x8b': FileFormats.CSV_GZIP,
+    b'\x28\xb5\x2f\xfd': FileFormats.CSV_ZSTD,
+    b'PAR1': FileFormats.PARQUET,
+    b'ARROW1': FileFormats.ARROW_FILE,
+    b'\xff\xff\xff\xff': FileFormats.ARROW_STREAM,  # continuation marker of the first IPC message
+}
+FORMAT_CONTENT_TYPES = {
+    'application/gzip': FileFormats.CSV_GZIP,
+    'application/x-gzip': FileFormats.CSV_GZIP,
+    'application/zstd': FileFormats.CSV_ZSTD,
+    'application/vnd.apache.parquet': FileFormats.PARQUET,
+    'application/x-parquet': FileFormats.PARQUET,
+    'application/vnd.apache.arrow.file': FileFormats.ARROW_FILE,
+    'application/vnd.apache.arrow.stream': FileFormats.ARROW_STREAM,
+}
+FORMAT_EXTENSIONS = {
+    '.gz': FileFormats.CSV_GZIP,
+    '.zst': FileFormats.CSV_ZSTD,
+    '.parquet': FileFormats.PARQUET,
+    '.arrow': FileFormats.ARROW_FILE,
+    '.feather': FileFormats.ARROW_FILE,
+    '.arrows': FileFormats.ARROW_STREAM,
+}
+CSV_CODECS: Dict[FileFormats, Literal['gzip', 'zstd']] = {
+    FileFormats.CSV_GZIP: 'gzip',
+    FileFormats.CSV_ZSTD: 'zstd',
+}
+
+
+def detect_format(fp: BinaryIO, filename: Optional[str] = None, content_type: Optional[str] = None) -> FileFormats:
+    """Magic bytes go first, since clients often send generic content type, then content type and extension.
+
+    Falls back to plain CSV, the file is rewound afterwards.
+    """
+    head = fp.read(8)
+    fp.seek(0)
+    for signature, file_format in FORMAT_SIGNATURES.items():
+        if head.startswith(signature):
+            return file_format
+
+    if content_type and content_type in FORMAT_CONTENT_TYPES:
+        return FORMAT_CONTENT_TYPES[content_type]
+
+    if filename:
+        return FORMAT_EXTENSIONS.get(os.path.splitext(filename.lower())[1], FileFormats.CSV)
+
+    return FileFormats.CSV
+
+
+def read_uploaded_file(
+    fp: Union[str, BinaryIO],
+    on_progress: Optional[ProgressCallback] = None,
+    file_format: FileFormats = FileFormats.CSV,
+) -> pa.Table:
+    """Raw file is consumed block by block, but the parsed table is returned in full.
+
+    Atoms aren't processed batch by batch, since duplicates are checked across the whole file and the blob
+    is sorted by `ATOMS_ORDER`, so memory still grows with the number of atoms, only raw bytes are bounded.
+    """
+    if isinstance(fp, str):
+        with open(fp, 'rb') as f:
+            return read_uploaded_file(f, on_progress, file_format)
+
+    source = pa.PythonFile(cast(io.IOBase, fp), mode='r')
     try:
-        df = csv.read_csv(fp, convert_options=opts).to_pandas(date_as_object=False)
-    except ValueError as e:
+        if file_format == FileFormats.PARQUET:
+            parquet_file = pq.ParquetFile(source)
+            _check_schema(parquet_file.schema_arrow)
+            return _read_batches(parquet_file.iter_batches(columns=list(Columns)), on_progress)
+
+        if file_format == FileFormats.ARROW_FILE:
+            file_reader = pa.ipc.open_file(source)
+            _check_schema(file_reader.schema)
+            batches = (file_reader.get_batch(i) for i in range(file_reader.num_record_batches))
+            return _read_batches(batches, on_progress)
+
+        if file_format == FileFormats.ARROW_STREAM:
+            stream_reader = pa.ipc.open_stream(source)
+            _check_schema(stream_reader.schema)
+            return _read_batches(stream_reader, on_progress)
+
+        if file_format in CSV_CODECS:
+            # Decompressed on the fly, block by block as the CSV reader consumes it.
+            # Not closed explicitly, since closing would close the uploaded file as well.
+            stream = pa.CompressedInputStream(source, CSV_CODECS[file_format])
+            return _read_csv(cast(IO[bytes], stream), on_progress)
+
+        return _read_csv(fp, on_progress)
+    except (pa.ArrowException, ValueError, KeyError) as e:  # KeyError is raised on missing columns
         raise InvalidFile(e)
-    _validate_data_frame(df)
-
-    summary_stats = calc_summary(df)
-    entry = EntryOrm(user_id=user_id, **summary_stats)
-
-    for _, row in df.iterrows():
-        entry.atoms.append(
-            AtomOrm(
-                entry_id=entry.id,
-                team=row[Columns.TEAM],
-                date=row[Columns.DATE],
-                merge_time=row[Columns.MERGE_TIME],
-                review_time=row[Columns.REVIEW_TIME],
-            )
-        )
-    return entry
 
 
-def _validate_data_frame(df: pd.DataFrame) -> None:
-    if df.size == 0:
-        raise InvalidFile('No data')
+def _read_csv(fp: IO[bytes], on_progress: Optional[ProgressCallback]) -> pa.Table:
+    # Only a single block of raw CSV is kept in memory at once, converted batches are kept till the end
+    read_opts = csv.ReadOptions(block_size=CSV_BLOCK_SIZE)
+    convert_opts = csv.ConvertOptions(column_types=PA_COLUMN_TYPES, include_columns=list(Columns))
+    with csv.open_csv(fp, read_options=read_opts, convert_options=convert_opts) as reader:
+        batches = []
+        for batch in reader:
+            batches.append(batch)
+            if on_progress:
+                on_progress(batch.num_rows)
+        return pa.Table.from_batches(batches, schema=reader.schema)
 
-    if df.duplicated([Columns.DATE, Columns.TEAM]).any():
-        raise InvalidFile('Duplicated values')
 
-    if not set(df.keys()).issuperset(Columns):
+ATOMS_SCHEMA = pa.schema([(col.value, PA_COLUMN_TYPES[col]) for col in Columns])
+
+
+def _type_kind(data_type: pa.DataType) -> Optional[str]:
+    if isinstance(data_type, pa.DictionaryType):
+        data_type = data_type.value_type
+    if pa.types.is_integer(data_type):
+        return 'integer'
+    if pa.types.is_string(data_type) or pa.types.is_large_string(data_type):
+        return 'string'
+    if pa.types.is_date(data_type) or pa.types.is_timestamp(data_type):
+        return 'date'
+    return None
+
+
+def _check_schema(schema: pa.Schema) -> None:
+    """Columnar files are typed, only casts within the same kind of type are allowed, e.g. int64 to int32"""
+    if not set(schema.names).issuperset(Columns):
         raise InvalidFile('Invalid columns')
 
-    if df[Columns.REVIEW_TIME].min() < 0:
-        raise InvalidFile(f'Negative values in column "{Columns.REVIEW_TIME}"')
+    for col in Columns:
+        kind = _type_kind(schema.field(col.value).type)
+        if kind is None or kind != _type_kind(PA_COLUMN_TYPES[col]):
+            raise InvalidFile(f'Invalid type of column "{col.value}"')
+
 
-    if df[Columns.MERGE_TIME].min() < 0:
-        raise InvalidFile(f'Negative values in column "{Columns.MERGE_TIME}"')
+def _read_batches(batches: Iterable[pa.RecordBatch], on_progress: Optional[ProgressCallback]) -> pa.Table:
+    out = []
+    for batch in batches:
+        # Safe casts, so overflowing integers or timestamps with time part are rejected
+        columns = [batch.column(col.value).cast(PA_COLUMN_TYPES[col]) for col in Columns]
+        out.append(pa.RecordBatch.from_arrays(columns, schema=ATOMS_SCHEMA))
+        if on_progress:
+            on_progress(batch.num_rows)
+    return pa.Table.from_batches(out, schema=ATOMS_SCHEMA)
+
+
+def hash_file(fp: BinaryIO) -> str:
+    """Streaming SHA-256 of file content, the file is rewound afterwards"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(CSV_BLOCK_SIZE), b''):
+        digest.update(chunk)
+    fp.seek(0)
+    return digest.hexdigest()
+
+
+async def find_duplicate_entry(db: AsyncSession, user_id: uuid.UUID, content_hash: str) -> Optional[EntryOrm]:
+    res = await db.execute(
+        select(EntryOrm)
+        .where(EntryOrm.user_id == user_id, EntryOrm.content_hash == content_hash)
+        .order_by(EntryOrm.dt)
+        .limit(1)
+    )
+    return res.scalar_one_or_none()
+
+
+def parse_atoms(
+    fp: Union[str, BinaryIO],
+    on_progress: Optional[ProgressCallback] = None,
+    file_format: FileFormats = FileFormats.CSV,
+) -> Tuple[pa.Table, Dict[Columns, Histogram]]:
+    """Reads and validates uploaded file, returns its atoms along with histograms of summary fields"""
+    table = read_uploaded_file(fp, on_progress, file_format)
+    _validate_table(table)
+
+    histograms = atoms_histograms(table)
+    for field_name, histogram in histograms.items():
+        if histogram.min() < 0:
+            raise InvalidFile(f'Negative values in column "{field_name}"')
+
+    return table, histograms
+
+
+def parse_uploaded_file(
+    fp: Union[str, BinaryIO],
+    user_id: uuid.UUID,
+    on_progress: Optional[ProgressCallback] = None,
+    file_format: FileFormats = FileFormats.CSV,
+) -> Tuple[EntryOrm, pa.Table]:
+    """Returns an entry with summary stats along with the table of its atoms.
+
+    Atoms are not attached to the entry, use `insert_atoms` once the entry is flushed.
+    """
+    table, histograms = parse_atoms(fp, on_progress, file_format)
+    entry = EntryOrm(
+        user_id=user_id,
+        atoms_blob=dump_atoms(table),
+        atoms_table=ATOMS_TABLE,
+        summary_state=_dump_state(histograms),
+        **calc_summary(table, histograms),
+    )
+    return entry, table
+
+
+def _validate_table(table: pa.Table) -> None:
+    if table.num_rows == 0:
+        raise InvalidFile('No data')
+
+    if not set(table.column_names).issuperset(Columns):
+        raise InvalidFile('Invalid columns')
+
+    if any(table[col].null_count for col in Columns):
+        raise InvalidFile('Missing values')
+
+    if table.group_by([Columns.DATE, Columns.TEAM]).aggregate([]).num_rows != table.num_rows:
+        raise InvalidFile('Duplicated values')
 
 
-def calc_summary(df: pd.DataFrame) -> Dict[str, Union[int, float]]:
-    out = {
-        'date_start': df[Columns.DATE].min(),
-        'date_end': df[Columns.DATE].max(),
-        'teams': list(df[Columns.TEAM].unique()),
+def calc_summary(table: pa.Table, histograms: Dict[Columns, Histogram]) -> Dict[str, Any]:
+    date_range = pc.min_max(table[Columns.DATE])
+    return {
+        'date_start': date_range['min'].as_py(),
+        'date_end': date_range['max'].as_py(),
+        'teams': pc.unique(table[Columns.TEAM]).to_pylist(),
+        **summary_stats(histograms),
     }
+
+
+def summary_stats(histograms: Dict[Columns, Histogram]) -> Dict[str, Union[int, float]]:
+    out = {}
     for field_name in SUMMARY_FIELDS:
-        series = df[field_name]
-        assert series.size > 0
+        histogram = histograms[field_name]
+        assert histogram.size > 0
 
-        for suffix, func in SUMMARY_FUNCTIONS.items():
-            out[f'{field_name}_{suffix}'] = func(series)
+        for suffix, value in histogram.summary().items():
+            out[f'{field_name}_{suffix}'] = value
 
     return out
 
 
-def _read_sql(session: Session, sql: str, **kwargs: Any) -> pd.DataFrame:
-    df = pd.read_sql_query(sql, session.connection(), **kwargs)
-    assert isinstance(df, pd.DataFrame)
-    return df
+def atoms_histograms(table: pa.Table) -> Dict[Columns, Histogram]:
+    return {field_name: Histogram.from_array(table[field_name]) for field_name in SUMMARY_FIELDS}
+
+
+ATOMS_BLOB_OPTIONS = pa.ipc.IpcWriteOptions(compression='zstd')
+# Canonical order of atoms, the same for every way of loading them, as outputs of visualizations depend on it.
+# Teams are ordered by code points, see `fetch_atoms`
+ATOMS_ORDER = [(Columns.DATE.value, 'ascending'), (Columns.TEAM.value, 'ascending')]
+
+
+def dump_atoms(table: pa.Table) -> bytes:
+    """Atoms are sorted once here, so they are loaded from the blob in canonical order as is"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, ATOMS_SCHEMA, options=ATOMS_BLOB_OPTIONS) as writer:
+        writer.write_table(table.select(list(Columns)).sort_by(ATOMS_ORDER))
+    return bytes(sink.getvalue().to_pybytes())
+
+
+def load_atoms(blob: bytes) -> pa.Table:
+    return pa.ipc.open_file(pa.BufferReader(blob)).read_all()
+
+
+def merge_atoms(blob: bytes, table: pa.Table) -> Tuple[bytes, pa.Table]:
+    """Replaces stored atoms with the same date and team, returns the new blob along with replaced atoms"""
+    stored = load_atoms(blob)
+    keys = table.select([Columns.DATE.value, Columns.TEAM.value])
+    replaced = stored.join(keys, keys.column_names, join_type='left semi')
+    kept = stored.join(keys, keys.column_names, join_type='left anti')
+    return dump_atoms(pa.concat_tables([kept, table.select(list(Columns))])), replaced
+
+
+ROLLUP_TYPES: Dict[str, pa.DataType] = {
+    'resolution': pa.string(),
+    Columns.DATE.value: pa.date32(),
+    Columns.TEAM.value: pa.string(),
+    **{col.value: pa.int64() for col in MT2COL.values()},
+}
+ROLLUP_SCHEMA = pa.schema(ROLLUP_TYPES)
+
+
+def rollup_atoms(table: pa.Table, replaced: Optional[pa.Table] = None) -> pa.Table:
+    """Sums of measures by date buckets of each of `ROLLUP_RESOLUTIONS` and team.
+
+    If `replaced` atoms are given, these are changes of the sums when they are replaced by atoms of the table.
+    """
+    keys = [Columns.DATE.value, Columns.TEAM.value]
+    measures = [col.value for col in MT2COL.values()]
+    schema = pa.schema({name: ROLLUP_TYPES[name] for name in [*keys, *measures]})
+    atoms = table.select(schema.names).cast(schema)
+    if replaced is not None:
+        replaced = replaced.select(schema.names).cast(schema)
+        negated = [pc.negate(replaced[name]) if name in measures else replaced[name] for name in schema.names]
+        atoms = pa.concat_tables([atoms, pa.Table.from_arrays(negated, schema=schema)])
+
+    dates = atoms[Columns.DATE].to_numpy()
+    rollups = []
+    for resolution in ROLLUP_RESOLUTIONS:
+        labels = pa.array(bucket_labels(dates, resolution), pa.date32())
+        buckets = pa.Table.from_arrays([labels, *atoms.columns[1:]], schema=schema)
+        grouped = buckets.group_by(keys).aggregate([(name, 'sum') for name in measures])
+        columns: List[Union[pa.Array[Any], pa.ChunkedArray[Any]]] = [
+            pa.repeat(resolution.value, grouped.num_rows),
+            *(grouped[name] for name in keys),
+            *(grouped[f'{name}_sum'] for name in measures),
+        ]
+        rollups.append(pa.Table.from_arrays(columns, schema=ROLLUP_SCHEMA))
+    return pa.concat_tables(rollups)
+
+
+ATOM_COLUMNS = ['entry_id', *(col.value for col in Columns)]
+ATOM_PK_COLUMNS = ['entry_id', Columns.DATE.value, Columns.TEAM.value]
+ATOM_APPEND_TABLE = 'atom_append'
+ROLLUP_COLUMNS = ['entry_id', *ROLLUP_SCHEMA.names]
+ROLLUP_PK_COLUMNS = ['entry_id', 'resolution', Columns.DATE.value, Columns.TEAM.value]
+ROLLUP_APPEND_TABLE = 'rollup_append'
+
+
+def atom_records(
+    entry_id: uuid.UUID,
+    table: pa.Table,
+    on_progress: Optional[ProgressCallback] = None,
+) -> Iterator[Tuple[Any, ...]]:
+    # Converting batch by batch, so python objects exist only for a single batch at once
+    for batch in table.select(list(Columns)).to_batches(max_chunksize=ATOMS_COPY_BATCH_SIZE):
+        yield from zip(itertools.repeat(entry_id), *(col.to_pylist() for col in batch.columns))
+        if on_progress:
+            on_progress(batch.num_rows)
+
 
+async def insert_atoms(
+    db: AsyncSession,
+    entry_id: uuid.UUID,
+    table: pa.Table,
+    on_progress: Optional[ProgressCallback] = None,
+) -> None:
+    """Bulk load atoms and their rollups with binary COPY within the current transaction of the session."""
+    rollups = await ingest_executor.run(rollup_atoms, table)
+    await _copy_rollups(db, RollupOrm.__tablename__, entry_id, rollups)
 
-async def df_for_entry(entry_id: uuid.UUID, db: AsyncSession) -> pd.DataFrame:
-    cols: List[InstrumentedAttribute[Any]] = [getattr(AtomOrm, col_name) for col_name in Columns]
-    df = await db.run_sync(
-        _read_sql,
-        sql=select(*cols).where(AtomOrm.entry_id == entry_id),
-        parse_dates=[Columns.DATE],
+    if not ATOMS_TABLE:  # atoms are stored in the blob of the entry only
+        if on_progress:
+            on_progress(table.num_rows)
+        return
+    await _copy_atoms(db, AtomOrm.__tablename__, entry_id, table, on_progress)
+
+
+async def _driver_connection(db: AsyncSession) -> Any:
+    """asyncpg connection of the current transaction of the session"""
+    conn = await db.connection()
+    raw_conn = await conn.get_raw_connection()
+    assert raw_conn.driver_connection is not None  # typing
+    return raw_conn.driver_connection
+
+
+async def _copy_atoms(
+    db: AsyncSession,
+    table_name: str,
+    entry_id: uuid.UUID,
+    table: pa.Table,
+    on_progress: Optional[ProgressCallback] = None,
+) -> None:
+    driver_conn = await _driver_connection(db)
+    await driver_conn.copy_records_to_table(
+        table_name,
+        records=atom_records(entry_id, table, on_progress),
+        columns=ATOM_COLUMNS,
+    )
+
+
+async def _copy_rollups(db: AsyncSession, table_name: str, entry_id: uuid.UUID, rollups: pa.Table) -> None:
+    driver_conn = await _driver_connection(db)
+    records = zip(itertools.repeat(entry_id), *(col.to_pylist() for col in rollups.columns))
+    await driver_conn.copy_records_to_table(table_name, records=records, columns=ROLLUP_COLUMNS)
+
+
+async def _update_rollups(db: AsyncSession, entry_id: uuid.UUID, changes: pa.Table) -> None:
+    """Adds changes of sums to rollups of the entry, see `rollup_atoms`"""
+    await db.execute(
+        text(f'CREATE TEMPORARY TABLE {ROLLUP_APPEND_TABLE} (LIKE {RollupOrm.__tablename__}) ON COMMIT DROP')
+    )
+    await _copy_rollups(db, ROLLUP_APPEND_TABLE, entry_id, changes)
+    appended = sa_table(ROLLUP_APPEND_TABLE, *(column(col_name) for col_name in ROLLUP_COLUMNS))
+
+    upsert = pg_insert(RollupOrm).from_select(ROLLUP_COLUMNS, select(appended))
+    upsert = upsert.on_conflict_do_update(
+        index_elements=ROLLUP_PK_COLUMNS,
+        set_={col.value: getattr(RollupOrm, col.value) + upsert.excluded[col.value] for col in MT2COL.values()},
     )
-    assert isinstance(df, pd.DataFrame)
-    return df
+    await db.execute(upsert)
+
+
+async def append_atoms(
+    db: AsyncSession,
+    entry: EntryOrm,
+    table: pa.Table,
+    histograms: Dict[Columns, Histogram],
+) -> None:
+    """Upserts atoms of the entry and updates its summary incrementally.
+
+    The entry has to be locked (`SELECT ... FOR UPDATE`) and have `summary_state` and `atoms_blob` loaded.
+    """
+    state = None if entry.summary_state is None else _load_state(entry.summary_state)
+    replaced = None
+
+    if entry.atoms_blob is not None:
+        if state is None:  # entries created before the state was introduced
+            state = atoms_histograms(load_atoms(entry.atoms_blob))
+        atoms_blob, replaced = await ingest_executor.run(merge_atoms, entry.atoms_blob, table)
+        entry.atoms_blob = atoms_blob
+
+    # Rows are kept up to date only if they have all atoms already, blob-less entries have nothing else
+    atoms_table = entry.atoms_blob is None or (ATOMS_TABLE and entry.atoms_table)
+    if entry.atoms_table and not atoms_table:  # rows wouldn't be updated anymore
+        await db.execute(delete(AtomOrm).where(AtomOrm.entry_id == entry.id))
+    entry.atoms_table = atoms_table
+    if atoms_table:
+        if state is None:
+            state = {}
+            for field_name in SUMMARY_FIELDS:
+                col = getattr(AtomOrm, field_name)
+                stmt = select(col, func.count()).where(AtomOrm.entry_id == entry.id).group_by(col)
+                state[field_name] = await _fetch_histogram(db, stmt)
+
+        # New atoms go to a temporary table first, so the replaced ones can be found before upserting
+        await db.execute(
+            text(f'CREATE TEMPORARY TABLE {ATOM_APPEND_TABLE} (LIKE {AtomOrm.__tablename__}) ON COMMIT DROP')
+        )
+        await _copy_atoms(db, ATOM_APPEND_TABLE, entry.id, table)
+        appended = sa_table(ATOM_APPEND_TABLE, *(column(col_name) for col_name in ATOM_COLUMNS))
+
+        if replaced is None:
+            same_atom = and_(*(getattr(AtomOrm, col_name) == appended.c[col_name] for col_name in ATOM_PK_COLUMNS))
+            stmt = select(*(getattr(AtomOrm, col.value) for col in Columns)).join(appended, same_atom)
+            rows = (await db.execute(stmt)).all()
+            replaced = pa.Table.from_pylist([row._asdict() for row in rows], schema=ATOMS_SCHEMA)
+
+        upsert = pg_insert(AtomOrm).from_select(ATOM_COLUMNS, select(appended))
+        upsert = upsert.on_conflict_do_update(
+            index_elements=ATOM_PK_COLUMNS,
+            set_={field_name: upsert.excluded[field_name] for field_name in SUMMARY_FIELDS},
+        )
+        await db.execute(upsert)
+
+    assert state is not None and replaced is not None
+    replaced_histograms = atoms_histograms(replaced)
+    for field_name in SUMMARY_FIELDS:
+        state[field_name] = state[field_name] - replaced_histograms[field_name] + histograms[field_name]
+
+    await _update_rollups(db, entry.id, await ingest_executor.run(rollup_atoms, table, replaced))
+
+    date_range = pc.min_max(table[Columns.DATE])
+    entry.date_start = min(entry.date_start, date_range['min'].as_py())
+    entry.date_end = max(entry.date_end, date_range['max'].as_py())
+    new_teams = cast(List[str], pc.unique(table[Columns.TEAM]).to_pylist())
+    entry.teams = entry.teams + [team for team in new_teams if team not in entry.teams]
+    for name, value in summary_stats(state).items():
+        setattr(entry, name, value)
+    entry.summary_state = _dump_state(state)
+    entry.content_hash = None  # doesn't match any uploaded file anymore
+    entry.version += 1
+
+
+async def _fetch_histogram(db: AsyncSession, stmt: Select[Tuple[int, int]]) -> Histogram:
+    """Builds a histogram from (value, count) rows"""
+    rows = (await db.execute(stmt)).all()
+    return Histogram.from_value_counts([value for value, _ in rows], [count for _, count in rows])
+
+
+def _dump_state(histograms: Dict[Columns, Histogram]) -> Dict[str, Any]:
+    return {field_name.value: histogram.to_dict() for field_name, histogram in histograms.items()}
+
+
+def _load_state(state: Dict[str, Any]) -> Dict[Columns, Histogram]:
+    return {Columns(field_name): Histogram.from_dict(data) for field_name, data in state.items()}
+
+
+PG_EPOCH_DAYS = 10957  # PostgreSQL dates are days since 2000-01-01
+PG_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+# Binary COPY tuple of (date, team code, review_time, merge_time): a number of fields, then length and value of each
+ATOM_COPY_DTYPE = np.dtype(
+    [
+        ('fields', '>i2'),
+        *itertools.chain.from_iterable(
+            [(f'{name}_length', '>i4'), (name, '>i4')] for name in ['date', 'team', 'review_time', 'merge_time']
+        ),
+    ]
+)
+# Attempts to encode teams of atoms being appended meanwhile, each one adds the teams missing from the dictionary
+FETCH_ATOMS_ATTEMPTS = 3
+
+
+async def fetch_atoms(db: AsyncSession, entry_id: uuid.UUID, where: Sequence[ColumnElement[bool]] = ()) -> pa.Table:
+    """Loads atoms matching all `where` clauses with binary COPY, decoding fixed width tuples straight into
+    typed columns.
+
+    Teams are dictionary encoded by PostgreSQL, the dictionary is sorted by code points and contains all teams
+    of the entry, even if some of them are filtered out. Atoms are in canonical order, see `ATOMS_ORDER`.
+    Teams of atoms missing from `teams` of the entry are added to the dictionary as well.
+    """
+    driver_conn = await _driver_connection(db)
+    codes_table = (
+        func.unnest(bindparam('teams', type_=ARRAY(String)))
+        .table_valued('team', with_ordinality='code')
+        .render_derived()
+    )
+    stmt = (
+        select(
+            AtomOrm.date,
+            func.coalesce(codes_table.c.code - 1, -1).cast(Integer),
+            AtomOrm.review_time,
+            AtomOrm.merge_time,
+        )
+        .outerjoin(codes_table, AtomOrm.team == codes_table.c.team)
+        .where(AtomOrm.entry_id == entry_id, *where)
+        .order_by(AtomOrm.date, codes_table.c.code)  # see `ATOMS_ORDER`
+    )
+    # teams of the entry are updated in the same transaction as atoms
+    known = set(
+        await driver_conn.fetchval(f'SELECT teams FROM {EntryOrm.__tablename__} WHERE id = $1', entry_id) or []
+    )
+    for _ in range(FETCH_ATOMS_ATTEMPTS):
+        teams = sorted(known)
+        # COPY doesn't support prepared statements, so asyncpg binds the parameters of the compiled query itself
+        compiled = stmt.params(teams=teams).compile(
+            dialect=db.get_bind().dialect, compile_kwargs={'render_postcompile': True}
+        )
+        assert compiled.positiontup is not None
+        buf = io.BytesIO()
+        await driver_conn.copy_from_query(
+            compiled.string,
+            *[compiled.params[name] for name in compiled.positiontup],
+            output=buf,
+            format='binary',
+        )
+
+        data = buf.getbuffer()
+        header = len(PG_COPY_SIGNATURE)
+        assert data[:header] == PG_COPY_SIGNATURE
+        # signature is followed by flags, length of header extension and the extension itself
+        header += 8 + int.from_bytes(data[header + 4 : header + 8], 'big')
+        count = (len(data) - header - 2) // ATOM_COPY_DTYPE.itemsize  # the trailer is a 16 bit -1
+        rows = np.frombuffer(data, ATOM_COPY_DTYPE, count=count, offset=header)
+
+        codes = rows['team'].astype(np.int32)
+        if (codes >= 0).all():
+            break
+        # atoms of a new team were appended between the queries, or `teams` of the entry lack some of them
+        missing = await driver_conn.fetchval(
+            f'SELECT array_agg(DISTINCT team) FROM {AtomOrm.__tablename__} WHERE entry_id = $1 AND team <> ALL($2)',
+            entry_id,
+            teams,
+        )
+        known.update(missing or [])
+    else:
+        raise RuntimeError(f'Teams of atoms of entry {entry_id} keep changing')
+
+    return pa.table(
+        {
+            Columns.REVIEW_TIME.value: pa.array(rows['review_time'].astype(np.int32)),
+            Columns.TEAM.value: pa.DictionaryArray.from_arrays(codes, pa.array(teams, pa.string())),
+            Columns.DATE.value: pa.array(rows['date'].astype(np.int32) + PG_EPOCH_DAYS).view(pa.date32()),
+            Columns.MERGE_TIME.value: pa.array(rows['merge_time'].astype(np.int32)),
+        }
+    )
+
+
+def atoms_to_df(table: pa.Table) -> pd.DataFrame:
+    """DataFrame of atoms as visualizations expect it.
+
+    Dates are datetime64, measures are widened to int64 so sums don't overflow and teams are categorical
+    with sorted categories, so grouping by team is ordered the same way as for strings. Rows stay in `ATOMS_ORDER`
+    of stored atoms, so date ranges are filtered by binary search, see `vis.filters.apply_filters`.
+    """
+    if not pa.types.is_dictionary(table.schema.field(Columns.TEAM.value).type):
+        teams = table[Columns.TEAM].combine_chunks()
+        dictionary = teams.unique()
+        dictionary = dictionary.take(pc.array_sort_indices(dictionary))
+        encoded = pa.DictionaryArray.from_arrays(pc.index_in(teams, value_set=dictionary), dictionary)
+        table = table.set_column(table.schema.get_field_index(Columns.TEAM.value), Columns.TEAM.value, encoded)
+
+    df = table.to_pandas(date_as_object=False)
+    return df.astype({field_name: 'int64' for field_name in (Columns.REVIEW_TIME, Columns.MERGE_TIME)})
+
+
+vis_data_cache: LRUCache[Tuple[str, ...], bytes]
+if CacheBackends(VIS_CACHE_BACKEND) == CacheBackends.DISK:
+    vis_data_cache = DiskCache('vis_data', VIS_CACHE_MAX_BYTES, VIS_CACHE_DIR)
+else:
+    vis_data_cache = LRUCache('vis_data', VIS_CACHE_MAX_BYTES, len)
+
+
+VIS_DATA_MEDIA_TYPES = {  # formats of vis data negotiated by the Accept header, JSON layouts are picked by a parameter
+    'application/x-ndjson': VisDataFormats.NDJSON,
+    'application/vnd.apache.arrow.stream': VisDataFormats.ARROW_STREAM,
+    'application/vnd.apache.parquet': VisDataFormats.PARQUET,
+    'application/x-parquet': VisDataFormats.PARQUET,
+}
+
+
+JSON_MEDIA_RANGES = {'application/json', 'application/*', '*/*'}
+
+
+def negotiate_vis_data_format(accept: Optional[str]) -> Optional[VisDataFormats]:
+    """Format of vis data preferred by the client, None for JSON or if no format is acceptable.
+
+    Media ranges are ranked by their q-values, the first listed one wins among equally ranked, q=0 is skipped.
+    """
+    best: Optional[VisDataFormats] = None
+    best_quality = 0.0
+    for media_range in (accept or '').split(','):
+        media_type, *params = [part.strip().lower() for part in media_range.split(';')]
+        if media_type not in VIS_DATA_MEDIA_TYPES and media_type not in JSON_MEDIA_RANGES:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > best_quality:
+            best, best_quality = VIS_DATA_MEDIA_TYPES.get(media_type), quality
+    return best
+
+
+def vis_data_media_type(data_format: VisDataFormats) -> str:
+    for media_type, media_format in VIS_DATA_MEDIA_TYPES.items():
+        if media_format == data_format:
+            return media_type
+    return 'application/json'
+
+
+def vis_data_key(
+    entry: EntryOrm, options: AnyVisType, data_format: VisDataFormats, metadata: Optional[Dict[str, str]] = None
+) -> Tuple[str, ...]:
+    """Output of a visualization only depends on its options and atoms of the entry, and on metadata embedded in it"""
+    options_hash = hashlib.sha256(options.json(sort_keys=True).encode())
+    if metadata:
+        options_hash.update(json.dumps(metadata, sort_keys=True).encode())
+    return (str(entry.id), str(entry.version), options_hash.hexdigest(), data_format.value)
+
+
+def render_vis_data(
+    options: AnyVisType, df: pd.DataFrame, data_format: VisDataFormats, metadata: Optional[Dict[str, str]] = None
+) -> bytes:
+    """Data of the visualization, in JSON formats an object with members which are added to the visualization.
+
+    Binary formats are complete responses, with `metadata` in their schema. NDJSON has output entries only.
+    Atoms of `df` are in `ATOMS_ORDER`, the way `df_for_entry` returns them.
+    """
+    return _dump_frame(options.apply_frame(df, sorted_by_date=True), data_format, metadata)
+
+
+def render_aggregated_vis_data(
+    options: AnyVisType,
+    aggregated: pd.DataFrame,
+    data_format: VisDataFormats,
+    metadata: Optional[Dict[str, str]] = None,
+) -> bytes:
+    """The same as `render_vis_data`, but from the output of `aggregate_for_vis`"""
+    return _dump_frame(options.apply_aggregated_frame(aggregated), data_format, metadata)
+
+
+def _dump_frame(frame: pd.DataFrame, data_format: VisDataFormats, metadata: Optional[Dict[str, str]]) -> bytes:
+    if data_format == VisDataFormats.ROWS:
+        return _dump_records(frame)
+    if data_format == VisDataFormats.NDJSON:
+        return dump_lines(frame)
+    if data_format == VisDataFormats.COLUMNAR:
+        return _dump_columns(frame)
+
+    table = _frame_to_table(frame, metadata)
+    sink = pa.BufferOutputStream()
+    if data_format == VisDataFormats.PARQUET:
+        pq.write_table(table, sink)
+    else:  # uncompressed, not every Arrow implementation supports compressed IPC
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _columns(frame: pd.DataFrame) -> Iterator[Tuple[str, 'pd.Series[Any]']]:
+    """Columns of the frame, categorical ones without unused categories"""
+    for name, col in frame.items():
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            col = col.cat.remove_unused_categories()
+        yield str(name), col
+
+
+def _iso_dates(col: 'pd.Series[Any]') -> npt.NDArray[np.str_]:
+    """Dates of the column as ISO strings, each distinct date is formatted once"""
+    days, inverse = np.unique(col.to_numpy().astype('datetime64[D]'), return_inverse=True)
+    return cast(npt.NDArray[np.str_], np.datetime_as_string(days))[inverse]
+
+
+def _with_iso_dates(frame: pd.DataFrame) -> pd.DataFrame:
+    dates = {str(name): _iso_dates(col) for name, col in frame.items() if pd.api.types.is_datetime64_dtype(col.dtype)}
+    return frame.assign(**dates)
+
+
+def _dump_records(frame: pd.DataFrame) -> bytes:
+    """The same JSON as of output entries, serialized by pandas without creating them"""
+    records = _with_iso_dates(frame).to_json(orient='records')
+    return b'{"data": ' + records.encode() + b'}'
+
+
+def dump_lines(frame: pd.DataFrame) -> bytes:
+    """Output entries of the frame as NDJSON, a line per entry, each one ends with a newline"""
+    return _with_iso_dates(frame).to_json(orient='records', lines=True).encode()
+
+
+def _dump_columns(frame: pd.DataFrame) -> bytes:
+    """Lists of values of frame columns, categorical ones are dictionary encoded with codes in place of values"""
+    columns: Dict[str, List[Any]] = {}
+    dictionaries: Dict[str, List[Any]] = {}
+    for name, col in _columns(frame):
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            dictionaries[name] = col.cat.categories.tolist()
+            columns[name] = col.cat.codes.tolist()
+        elif pd.api.types.is_datetime64_dtype(col.dtype):
+            columns[name] = _iso_dates(col).tolist()
+        else:
+            columns[name] = col.tolist()
+    return json.dumps({'columns': columns, 'dictionaries': dictionaries}).encode()
+
+
+def _frame_to_table(frame: pd.DataFrame, metadata: Optional[Dict[str, str]]) -> pa.Table:
+    """Frame columns as Arrow arrays without copying values, categorical ones are dictionary encoded and dates
+    are date32, so the table reads back the same way as the JSON formats do
+    """
+    arrays: List[Union[pa.Array[Any], pa.ChunkedArray[Any]]] = []
+    for _, col in _columns(frame):
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            arrays.append(pa.DictionaryArray.from_arrays(col.cat.codes.to_numpy(), col.cat.categories.to_numpy()))
+        elif pd.api.types.is_datetime64_dtype(col.dtype):
+            arrays.append(pa.array(col.to_numpy().astype('datetime64[D]')))
+        else:
+            arrays.append(pa.array(col.to_numpy()))
+    return pa.Table.from_arrays(arrays, names=[str(name) for name in frame.columns], metadata=metadata)
+
+
+async def aggregate_for_vis(entry: EntryOrm, db: AsyncSession, options: AnyVisType) -> Optional[pd.DataFrame]:
+    """Atoms of the entry filtered and aggregated for the visualization by the database.
+
+    Rollups are used when filters allow it, then rendering cost depends on the number of buckets only.
+    None if the output has to be made from atoms: the visualization doesn't aggregate them, some of its filters
+    can't be pushed down, or atoms of the entry are cached already or aren't in the atom table.
+    """
+    aggregation = options.aggregation()
+    if not VIS_SQL_AGGREGATION or aggregation is None:
+        return None
+    stmt = _aggregation_query(entry, aggregation, options.filters)
+    if stmt is None:
+        return None
+
+    res = await db.execute(stmt)
+    df = pd.DataFrame(res.all(), columns=list(res.keys()))
+    df = df.astype({col.value: 'int64' for col in MT2COL.values()})
+    if Columns.DATE.value in df:
+        df[Columns.DATE.value] = pd.to_datetime(df[Columns.DATE.value])
+    return df.set_index([col.value for col in (Columns.DATE, Columns.TEAM) if col.value in df]).sort_index()
+
+
+def _aggregation_query(
+    entry: EntryOrm, aggregation: Aggregation, filters: Sequence[AnyDataFilter]
+) -> Optional[Select[Any]]:
+    for resolution in aggregation.rollup_resolutions():
+        where, rest = compile_filters(filters, resolution)
+        if not rest:
+            return aggregation.rollup_query(resolution, [RollupOrm.entry_id == entry.id, *where])
+
+    if not entry.atoms_table or _df_key(entry) in entry_df_cache:  # aggregating cached atoms in pandas is faster
+        return None
+    where, rest = compile_filters(filters)
+    if rest:
+        return None
+    return aggregation.query([AtomOrm.entry_id == entry.id, *where])
+
+
+# Frames by entry id and version, so a change of atoms made by any process is seen by the rest of them
+entry_df_cache: LRUCache[Tuple[uuid.UUID, int], pd.DataFrame] = LRUCache(
+    'entry_df', ENTRY_CACHE_MAX_BYTES, lambda df: int(df.memory_usage(deep=True).sum())
+)
+
+
+def _df_key(entry: EntryOrm) -> Tuple[uuid.UUID, int]:
+    return entry.id, entry.version
+
+
+def invalidate_entry_caches(entry_id: uuid.UUID) -> None:
+    """Has to be called after any committed change of entry atoms, frees outdated values of this process"""
+    entry_df_cache.invalidate_where(lambda key: key[0] == entry_id)
+    vis_data_cache.invalidate_where(lambda key: key[0] == str(entry_id))
+
+
+async def df_for_entry(entry: EntryOrm, db: AsyncSession, filters: Sequence[AnyDataFilter] = ()) -> pd.DataFrame:
+    """Atoms of the entry, at least the ones matching the filters.
+
+    The whole frame is cached by the version of the entry. On a cache miss, filters which can be pushed down
+    are applied by the query to the atoms table if all atoms of the entry are there, such a partial frame
+    isn't cached.
+    Filters are not guaranteed to be applied, callers still apply all of them, so the result doesn't depend on
+    the way atoms were loaded.
+
+    The frame is shared with other requests, so it must not be modified in place.
+    """
+    where, _ = compile_filters(filters)
+    if where and entry.atoms_table and _df_key(entry) not in entry_df_cache:
+        return atoms_to_df(await fetch_atoms(db, entry.id, where))
+    return await entry_df_cache.get_or_load(_df_key(entry), lambda: _load_df(entry.id, db))
+
+
+async def _load_df(entry_id: uuid.UUID, db: AsyncSession) -> pd.DataFrame:
+    res = await db.execute(select(EntryOrm.atoms_blob).where(EntryOrm.id == entry_id))
+    blob = res.scalar_one_or_none()
+    table = load_atoms(blob) if blob is not None else await fetch_atoms(db, entry_id)
+    return atoms_to_df(table)
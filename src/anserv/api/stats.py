@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import math
+from typing import Any, Dict, List, Union
+
+import numpy as np
+import numpy.typing as npt
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from const import SUMMARY_FUNCTIONS
+
+
+class Histogram:
+    """Exact histogram of an integer column: sorted distinct values with their counts.
+
+    Built with a single hashing pass over the column, all summary statistics are then calculated
+    from distinct values only. Matches pandas semantics of `SUMMARY_FUNCTIONS`.
+
+    Histograms are mergeable, so they are stored along with an entry as a state for incremental updates.
+    """
+
+    def __init__(self, values: npt.NDArray[np.int64], counts: npt.NDArray[np.int64]):
+        self.values = values
+        self.counts = counts
+        self.cumcounts = np.cumsum(counts)
+
+    @classmethod
+    def from_value_counts(cls, values: npt.ArrayLike, counts: npt.ArrayLike) -> Histogram:
+        """Values have to be unique, but not necessarily sorted"""
+        values_arr = np.asarray(values, dtype=np.int64)
+        counts_arr = np.asarray(counts, dtype=np.int64)
+        order = np.argsort(values_arr)
+        return cls(values_arr[order], counts_arr[order])
+
+    @classmethod
+    def from_array(cls, arr: pa.ChunkedArray[Any]) -> Histogram:
+        value_counts = pc.value_counts(arr)
+        return cls.from_value_counts(
+            value_counts.field('values').to_numpy(),
+            value_counts.field('counts').to_numpy(),
+        )
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, List[int]]) -> Histogram:
+        return cls(np.asarray(data['values'], dtype=np.int64), np.asarray(data['counts'], dtype=np.int64))
+
+    def to_dict(self) -> Dict[str, List[int]]:
+        return {'values': self.values.tolist(), 'counts': self.counts.tolist()}
+
+    def __add__(self, other: Histogram) -> Histogram:
+        return self._combine(other.values, other.counts)
+
+    def __sub__(self, other: Histogram) -> Histogram:
+        return self._combine(other.values, -other.counts)
+
+    def _combine(self, values: npt.NDArray[np.int64], counts: npt.NDArray[np.int64]) -> Histogram:
+        all_values, inverse = np.unique(np.concatenate([self.values, values]), return_inverse=True)
+        all_counts = np.zeros(all_values.size, dtype=np.int64)
+        np.add.at(all_counts, inverse, np.concatenate([self.counts, counts]))
+        assert (all_counts >= 0).all(), 'Subtracting values which are not in histogram'
+
+        non_empty = all_counts > 0
+        return Histogram(all_values[non_empty], all_counts[non_empty])
+
+    @property
+    def size(self) -> int:
+        return int(self.cumcounts[-1]) if self.cumcounts.size else 0
+
+    def nth(self, n: int) -> int:
+        """n-th (zero based) value of the sorted column"""
+        return int(self.values[np.searchsorted(self.cumcounts, n, side='right')])
+
+    def min(self) -> int:
+        return int(self.values[0])
+
+    def max(self) -> int:
+        return int(self.values[-1])
+
+    def mean(self) -> float:
+        return int((self.values * self.counts).sum()) / self.size
+
+    def median(self) -> float:
+        size = self.size
+        if size % 2:
+            return float(self.nth(size // 2))
+        return (self.nth(size // 2 - 1) + self.nth(size // 2)) / 2
+
+    def quantile(self, q: float) -> float:
+        # Linear interpolation, the same way numpy does
+        index = q * (self.size - 1)
+        lo = math.floor(index)
+        a = float(self.nth(lo))
+        b = float(self.nth(min(lo + 1, self.size - 1)))
+        t = index - lo
+        if t >= 0.5:
+            return b - (b - a) * (1 - t)
+        return a + (b - a) * t
+
+    def mode(self) -> int:
+        return int(self.values[np.argmax(self.counts)])  # the smallest one on ties
+
+    def std(self) -> float:
+        if self.size < 2:
+            return math.nan
+        deviation = (self.values - self.mean()) ** 2
+        return math.sqrt(float((deviation * self.counts).sum()) / (self.size - 1))
+
+    def summary(self) -> Dict[str, Union[int, float]]:
+        out = {
+            'min': self.min(),
+            'max': self.max(),
+            'mean': self.mean(),
+            'median': self.median(),
+            'quantile_10': self.quantile(0.1),
+            'quantile_90': self.quantile(0.9),
+            'mode': self.mode(),
+            'std': self.std(),
+        }
+        assert out.keys() == SUMMARY_FUNCTIONS.keys()
+        return out
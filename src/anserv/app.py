@@ -2,23 +2,74 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-import tempfile
+import contextlib
+import os
 import uuid
-from typing import List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
 
-from fastapi import Depends, FastAPI, Response, UploadFile, status
+from fastapi import Depends, FastAPI, Header, Query, Request, Response, UploadFile, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy import and_, or_, select
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
+from starlette.concurrency import run_in_threadpool
 
+from api import metrics
 from api.auth import Token, get_user, get_user_or_none, login
-from api.models import EntrySummary, Visualization, VisualizationCreatePayload, VisualizationWithData
-from api.services import InvalidFile, df_for_entry, parse_uploaded_file
+from api.cache import DiskCache
+from api.executors import ingest_executor, password_executor, vis_executor
+from api.jobs import IngestJob, QueueFull, ingest_queue, spool_upload
+from api.models import (
+    EntrySummary,
+    Visualization,
+    VisualizationCreatePayload,
+    VisualizationWithColumns,
+    VisualizationWithData,
+)
+from api.pagination import PAGE_RESPONSES, page_columns, page_model, paginate, parse_fields, project, split_page
+from api.services import (
+    InvalidFile,
+    aggregate_for_vis,
+    append_atoms,
+    detect_format,
+    df_for_entry,
+    dump_lines,
+    find_duplicate_entry,
+    hash_file,
+    insert_atoms,
+    invalidate_entry_caches,
+    negotiate_vis_data_format,
+    parse_atoms,
+    parse_uploaded_file,
+    render_aggregated_vis_data,
+    render_vis_data,
+    vis_data_cache,
+    vis_data_key,
+    vis_data_media_type,
+)
+from conf import LISTING_MAX_LIMIT, METRICS_PUBLIC, VIS_STREAM_CHUNK_ROWS
+from const import FileFormats, VisDataFormats
 from db.orm import EntryOrm, UserOrm, VisualizationOrm
-from db.utils import get_db
+from db.utils import async_session, get_db
 
-app = FastAPI()
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    ingest_queue.start()
+    yield
+    await ingest_queue.stop()
+    ingest_executor.shutdown()
+    vis_executor.shutdown()
+    password_executor.shutdown()
+    if isinstance(vis_data_cache, DiskCache):
+        await vis_data_cache.flush()
+        vis_data_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get('/')
@@ -26,42 +77,118 @@ def root() -> Response:
     return Response()
 
 
+@app.get('/metrics/')
+def metrics_detail(user: Optional[UserOrm] = Depends(get_user_or_none)) -> Dict[str, float]:
+    if user is None and not METRICS_PUBLIC:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail='Not authenticated',
+            headers={'WWW-Authenticate': 'Bearer'},
+        )
+    return metrics.snapshot()
+
+
 app.post('/auth/token/', response_model=Token)(login)
 
 
-@app.post('/entries/', status_code=201)
+@app.post('/entries/', status_code=201, response_model=EntrySummary, responses={202: {'model': IngestJob}})
 async def entry_create(
     payload: UploadFile,
+    response: Response,
+    background: bool = False,
+    force: bool = Query(False, description='Create a new entry even if the same file was uploaded before'),
     db: AsyncSession = Depends(get_db),
     user: UserOrm = Depends(get_user),
-) -> EntrySummary:
-    # TODO: make a more efficient implementation of stream usage.
-    # Probably would be better without a tempfile
-    with tempfile.NamedTemporaryFile(mode='wb', suffix=payload.filename) as tmp:
-        tmp.write(await payload.read())
-        tmp.seek(0)
+) -> Union[EntrySummary, Response]:
+    content_hash = await ingest_executor.run(hash_file, payload.file)
+    file_format = await ingest_executor.run(detect_format, payload.file, payload.filename, payload.content_type)
+    if not force:
+        duplicate = await find_duplicate_entry(db, user.id, content_hash)
+        if duplicate is not None:
+            response.status_code = status.HTTP_200_OK
+            return EntrySummary.from_orm(duplicate)
+
+    if background:
+        return await _entry_create_background(payload, user, content_hash, file_format)
 
-        try:
-            entry = parse_uploaded_file(tmp.name, user.id)
-        except InvalidFile:
-            raise HTTPException(422)
+    try:
+        entry, table = await ingest_executor.run(parse_uploaded_file, payload.file, user.id, file_format=file_format)
+    except InvalidFile:
+        raise HTTPException(422)
 
+    entry.content_hash = content_hash
     db.add(entry)
+    await db.flush()
+    await insert_atoms(db, entry.id, table)
     await db.commit()
 
     return EntrySummary.from_orm(entry)
 
 
-@app.get('/entries/')
+async def _entry_create_background(
+    payload: UploadFile, user: UserOrm, content_hash: str, file_format: FileFormats
+) -> Response:
+    queue_full_exception = HTTPException(503, detail='Too many pending uploads', headers={'Retry-After': '10'})
+    if ingest_queue.is_full():
+        raise queue_full_exception
+
+    path = await run_in_threadpool(spool_upload, payload.file)
+    try:
+        job = ingest_queue.submit(user.id, path, content_hash, file_format)
+    except QueueFull:
+        os.unlink(path)
+        raise queue_full_exception
+
+    return JSONResponse(
+        jsonable_encoder(job),
+        status_code=status.HTTP_202_ACCEPTED,
+        headers={'Location': app.url_path_for('entry_job_detail', job_id=str(job.id))},
+    )
+
+
+@app.get('/entries/jobs/{job_id}/')
+async def entry_job_detail(
+    job_id: uuid.UUID,
+    user: UserOrm = Depends(get_user),
+) -> IngestJob:
+    job = ingest_queue.get(job_id, user.id)
+    if job is None:
+        raise HTTPException(404)
+    return job
+
+
+LIMIT_QUERY = Query(None, ge=1, le=LISTING_MAX_LIMIT, description='Page size, all items by default')
+CURSOR_QUERY = Query(None, description='Cursor of the next page, it is in the Link header of the previous one')
+FIELDS_QUERY = Query(None, description='Comma separated fields of items, all of them by default')
+
+
+@app.get('/entries/', response_model=page_model(EntrySummary), responses=PAGE_RESPONSES)
 async def entries_list(
+    request: Request,
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    fields: Optional[str] = FIELDS_QUERY,
     db: AsyncSession = Depends(get_db),
     user: UserOrm = Depends(get_user),
-) -> List[EntrySummary]:
-    res = await db.execute(select(EntryOrm).where(EntryOrm.user_id == user.id))
-    out = []
-    for (entry,) in res.all():
-        out.append(EntrySummary.from_orm(entry))
-    return out
+) -> Response:
+    field_names = parse_fields(fields, EntrySummary)
+    columns = page_columns(EntryOrm, field_names or list(EntrySummary.__fields__))
+    stmt = paginate(select(*columns).where(EntryOrm.user_id == user.id), EntryOrm, cursor, limit)
+    res = await db.execute(stmt)
+    rows, next_cursor = split_page(res.all(), limit)
+
+    if field_names is None:
+        content: List[Any] = [EntrySummary.parse_obj(row._mapping) for row in rows]
+    else:
+        content = project(rows, field_names)
+    return _page_response(request, content, next_cursor)
+
+
+def _page_response(request: Request, content: List[Any], next_cursor: Optional[str]) -> Response:
+    headers = {}
+    if next_cursor is not None:
+        headers['Link'] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    return JSONResponse(jsonable_encoder(content), headers=headers)
 
 
 @app.get('/entries/{entry_id}/')
@@ -77,6 +204,38 @@ async def entry_detail(
     return EntrySummary.from_orm(row[0])
 
 
+@app.post('/entries/{entry_id}/append/')
+async def entry_append(
+    entry_id: uuid.UUID,
+    payload: UploadFile,
+    db: AsyncSession = Depends(get_db),
+    user: UserOrm = Depends(get_user),
+) -> EntrySummary:
+    """Adds atoms to the entry, existing atoms with the same date and team are replaced"""
+    try:
+        file_format = await ingest_executor.run(detect_format, payload.file, payload.filename, payload.content_type)
+        table, histograms = await ingest_executor.run(parse_atoms, payload.file, file_format=file_format)
+    except InvalidFile:
+        raise HTTPException(422)
+
+    res = await db.execute(
+        select(EntryOrm)
+        .where(EntryOrm.user_id == user.id, EntryOrm.id == entry_id)
+        .options(undefer(EntryOrm.summary_state), undefer(EntryOrm.atoms_blob))
+        .with_for_update()
+    )
+    row = res.one_or_none()
+    if not row:
+        raise HTTPException(404)
+
+    entry = row[0]
+    await append_atoms(db, entry, table, histograms)
+    await db.commit()
+    invalidate_entry_caches(entry.id)
+
+    return EntrySummary.from_orm(entry)
+
+
 @app.delete('/entries/{entry_id}/')
 async def entry_remove(
     entry_id: uuid.UUID,
@@ -90,6 +249,7 @@ async def entry_remove(
 
     await db.delete(row[0])
     await db.commit()
+    invalidate_entry_caches(entry_id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -111,29 +271,56 @@ async def vis_create(
     return Visualization.from_orm(vis)
 
 
-@app.get('/vis/')
+@app.get('/vis/', response_model=page_model(Visualization), responses=PAGE_RESPONSES)
 async def vis_list(
+    request: Request,
+    entry_id: Optional[uuid.UUID] = None,
+    limit: Optional[int] = LIMIT_QUERY,
+    cursor: Optional[str] = CURSOR_QUERY,
+    fields: Optional[str] = FIELDS_QUERY,
     db: AsyncSession = Depends(get_db),
     user: UserOrm = Depends(get_user),
-    entry_id: Optional[uuid.UUID] = None,
-) -> List[Visualization]:
-    stmt = select(VisualizationOrm).join(EntryOrm).where(EntryOrm.user_id == user.id)
+) -> Response:
+    field_names = parse_fields(fields, Visualization)
+    columns = page_columns(VisualizationOrm, field_names or list(Visualization.__fields__))
+    stmt = select(*columns).join(EntryOrm).where(EntryOrm.user_id == user.id)
     if entry_id:
         stmt = stmt.where(VisualizationOrm.entry_id == entry_id)
 
-    res = await db.execute(stmt)
-    out = []
-    for row in res.all():
-        out.append(Visualization.from_orm(row[0]))
-    return out
-
-
-@app.get('/vis/{vis_id}/')
+    res = await db.execute(paginate(stmt, VisualizationOrm, cursor, limit))
+    rows, next_cursor = split_page(res.all(), limit)
+
+    if field_names is None:
+        content: List[Any] = [Visualization.parse_obj(row._mapping) for row in rows]
+    else:  # options are returned as stored, without parsing them
+        content = project(rows, field_names)
+    return _page_response(request, content, next_cursor)
+
+
+@app.get(
+    '/vis/{vis_id}/',
+    response_model=Union[VisualizationWithData, VisualizationWithColumns],
+    responses={
+        200: {
+            'content': {
+                'application/x-ndjson': {},
+                'application/vnd.apache.arrow.stream': {},
+                'application/vnd.apache.parquet': {},
+            },
+            'description': (
+                'Other formats are negotiated by the Accept header. NDJSON has the visualization on the first line, '
+                'binary formats have it in schema metadata'
+            ),
+        }
+    },
+)
 async def vis_detail(
     vis_id: uuid.UUID,
+    data_format: VisDataFormats = Query(VisDataFormats.ROWS, alias='format'),
+    accept: Optional[str] = Header(None),
     db: AsyncSession = Depends(get_db),
     user: UserOrm = Depends(get_user_or_none),
-) -> VisualizationWithData:
+) -> Response:
     # checking access
     if user is None:
         filter_stmt = VisualizationOrm.is_public == True
@@ -143,16 +330,59 @@ async def vis_detail(
             VisualizationOrm.is_public == True,
         )
 
-    res = await db.execute(select(VisualizationOrm).join(EntryOrm).filter(filter_stmt))
+    res = await db.execute(select(VisualizationOrm, EntryOrm).join(EntryOrm).filter(filter_stmt))
     try:
-        vis = res.one()[0]
+        vis, entry = res.one()
     except NoResultFound:
         raise HTTPException(404)
 
     vis_model = Visualization.from_orm(vis)
-    df = await df_for_entry(vis.entry_id, db)
-    output = vis_model.options.apply(df)
-    return VisualizationWithData(data=output, **vis_model.dict())
+    data_format = negotiate_vis_data_format(accept) or data_format
+    media_type = vis_data_media_type(data_format)
+    headers = {'Vary': 'Accept'}
+    if data_format == VisDataFormats.NDJSON:
+        return StreamingResponse(_stream_vis_data(vis_model, entry), media_type=media_type, headers=headers)
+
+    binary = media_type != 'application/json'
+    metadata = {'visualization': vis_model.json()} if binary else None
+
+    async def render() -> bytes:
+        aggregated = await aggregate_for_vis(entry, db, vis_model.options)
+        if aggregated is not None:
+            return await vis_executor.run(
+                render_aggregated_vis_data, vis_model.options, aggregated, data_format, metadata
+            )
+        df = await df_for_entry(entry, db, vis_model.options.filters)
+        return await vis_executor.run(render_vis_data, vis_model.options, df, data_format, metadata)
+
+    # Access is checked above, so sharing settings don't affect cached data, except the ones embedded in metadata
+    data = await vis_data_cache.get_or_load(vis_data_key(entry, vis_model.options, data_format, metadata), render)
+    if binary:
+        return Response(data, media_type=media_type, headers=headers)
+    # Members of serialized data are spliced into the response as is, without validating output entries again
+    content = vis_model.json().encode()[:-1] + b', ' + data[1:]
+    return Response(content, media_type=media_type, headers=headers)
+
+
+async def _stream_vis_data(vis_model: Visualization, entry: EntryOrm) -> AsyncIterator[bytes]:
+    """The visualization line is sent right away, then output entries are serialized chunk by chunk.
+
+    Output isn't cached. Atoms are loaded with a session of its own, which doesn't depend on the lifetime
+    of request dependencies.
+    """
+    yield vis_model.json().encode() + b'\n'
+
+    options = vis_model.options
+    async with async_session() as db:
+        aggregated = await aggregate_for_vis(entry, db, options)
+        df = await df_for_entry(entry, db, options.filters) if aggregated is None else None
+    if aggregated is not None:
+        frame = await vis_executor.run(options.apply_aggregated_frame, aggregated)
+    else:
+        frame = await vis_executor.run(options.apply_frame, df, sorted_by_date=True)
+
+    for start in range(0, len(frame), VIS_STREAM_CHUNK_ROWS):
+        yield await vis_executor.run(dump_lines, frame.iloc[start : start + VIS_STREAM_CHUNK_ROWS])
 
 
 @app.delete('/vis/{vis_id}/')
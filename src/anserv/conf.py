@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 BASE_URL = os.getenv('BASE_URL', 'http://localhost:8000')
 
@@ -17,3 +18,53 @@ SQLALCHEMY_USE_NULLPOOL = os.getenv('SQLALCHEMY_USE_NULLPOOL', '').lower() in ['
 AUTH_SECRET_KEY = os.getenv('AUTH_SECRET_KEY', 'b06a6d47bac342f9887c7c6594468a57d02e3de26aeb4549a4aa3090c7c81002')
 AUTH_ALGORITHM = 'HS256'
 AUTH_TOKEN_EXPIRE_MINUTES = 12 * 60
+
+# Process-local cache of users authenticated by tokens, see `api.auth.user_cache`. Changes made by other processes
+# are seen once cached users expire.
+AUTH_USER_CACHE_SIZE = int(os.getenv('AUTH_USER_CACHE_SIZE', 10_000))  # number of users
+AUTH_USER_CACHE_TTL = float(os.getenv('AUTH_USER_CACHE_TTL', 60))  # seconds
+# Verified tokens are cached until they expire, so signatures of repeated ones are not checked again
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', 10_000))  # number of tokens
+
+# Uploaded CSV files are parsed incrementally, this is the size of a single chunk in bytes
+CSV_BLOCK_SIZE = int(os.getenv('CSV_BLOCK_SIZE', 1024 * 1024))
+
+# Number of rows converted to python objects at once while copying atoms to the database
+ATOMS_COPY_BATCH_SIZE = int(os.getenv('ATOMS_COPY_BATCH_SIZE', 10_000))
+
+# Atoms are always stored as a compressed Arrow blob of the entry, which is what visualizations load.
+# Rows of the `atom` table are only needed for SQL consumers, writing them can be disabled.
+ATOMS_TABLE = os.getenv('ATOMS_TABLE', 'true').lower() in ['true', '1']
+
+# Size of the process-local cache of entry DataFrames, see `api.services.df_for_entry`
+ENTRY_CACHE_MAX_BYTES = int(os.getenv('ENTRY_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Aggregating visualizations are calculated by the database from rollups of entries or the `atom` table, so only
+# aggregated rows are transferred, see `api.services.aggregate_for_vis`
+VIS_SQL_AGGREGATION = os.getenv('VIS_SQL_AGGREGATION', 'true').lower() in ['true', '1']
+
+# Cache of serialized visualization data, keyed by entry version and visualization options
+VIS_CACHE_BACKEND = os.getenv('VIS_CACHE_BACKEND', 'memory')  # "memory" or "disk"
+VIS_CACHE_MAX_BYTES = int(os.getenv('VIS_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+VIS_CACHE_DIR = os.getenv('VIS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'anserv-vis-cache'))
+
+# Streamed visualization data (`Accept: application/x-ndjson`) is serialized and sent by this many output entries
+VIS_STREAM_CHUNK_ROWS = int(os.getenv('VIS_STREAM_CHUNK_ROWS', 10_000))
+
+# Maximal page size of listings (`GET /entries/?limit=` and `GET /vis/?limit=`)
+LISTING_MAX_LIMIT = int(os.getenv('LISTING_MAX_LIMIT', 1000))
+
+# Background ingestion of uploaded files (`POST /entries/?background=true`)
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 2))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 16))  # pending jobs, new uploads are rejected above it
+INGEST_JOBS_HISTORY = int(os.getenv('INGEST_JOBS_HISTORY', 1000))  # finished jobs kept for status requests
+
+# Metrics of the process (`GET /metrics/`) are available to any authenticated user, or to anyone if public
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', '').lower() in ['true', '1']
+
+# Pools running CPU bound work out of the event loop, see `api.executors`
+INGEST_EXECUTOR_WORKERS = int(os.getenv('INGEST_EXECUTOR_WORKERS', 4))
+VIS_EXECUTOR_TYPE = os.getenv('VIS_EXECUTOR_TYPE', 'thread')  # "thread" or "process"
+VIS_EXECUTOR_WORKERS = int(os.getenv('VIS_EXECUTOR_WORKERS', 4))
+PASSWORD_EXECUTOR_WORKERS = int(os.getenv('PASSWORD_EXECUTOR_WORKERS', 2))
+PASSWORD_EXECUTOR_QUEUE_SIZE = int(os.getenv('PASSWORD_EXECUTOR_QUEUE_SIZE', 32))  # logins waiting for a worker
@@ -33,12 +33,29 @@ class Columns(str, enum.Enum):
     MERGE_TIME = 'merge_time'
 
 
+class FileFormats(str, enum.Enum):
+    CSV = 'csv'
+    CSV_GZIP = 'csv.gz'
+    CSV_ZSTD = 'csv.zst'
+    PARQUET = 'parquet'
+    ARROW_FILE = 'arrow'
+    ARROW_STREAM = 'arrows'
+
+
+class VisDataFormats(str, enum.Enum):
+    ROWS = 'rows'  # list of output entries
+    COLUMNAR = 'columnar'  # list of values per field of output entries, strings are dictionary encoded
+    ARROW_STREAM = 'arrows'  # Arrow IPC stream of output entries, the visualization is in the schema metadata
+    PARQUET = 'parquet'  # the same as `ARROW_STREAM`, but in a Parquet file
+    NDJSON = 'ndjson'  # the visualization on the first line, then an output entry per line, streamed as built
+
+
 MT2COL = {  # Measure type to column name
     MeasureTypes.REVIEW: Columns.REVIEW_TIME,
     MeasureTypes.MERGE: Columns.MERGE_TIME,
 }
 
-PA_COLUMN_TYPES = {  # Input CSV format for pyarrow
+PA_COLUMN_TYPES: Dict[Columns, pa.DataType] = {  # Input CSV format for pyarrow
     Columns.REVIEW_TIME: pa.int32(),
     Columns.TEAM: pa.string(),
     Columns.DATE: pa.date32(),
@@ -46,6 +63,7 @@ PA_COLUMN_TYPES = {  # Input CSV format for pyarrow
 }
 
 SUMMARY_FIELDS = [Columns.MERGE_TIME, Columns.REVIEW_TIME]
+# Reference pandas implementation of summary stats, ingest uses `api.stats.Histogram` with the same semantics
 SUMMARY_FUNCTIONS: Dict[str, Callable[[pd.Series[int]], Union[int, float]]] = {
     'min': lambda s: int(s.min()),
     'max': lambda s: int(s.max()),
@@ -1,8 +1,20 @@
 import datetime
 import uuid
-from typing import Any, Dict, List
-
-from sqlalchemy import Boolean, Date, DateTime, Float, ForeignKey, Integer, String, Uuid
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Date,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    Uuid,
+)
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -23,6 +35,10 @@ class UserOrm(Base):
 
 class EntryOrm(Base):
     __tablename__ = 'entry'
+    __table_args__ = (
+        Index('ix_entry_user_id_dt_id', 'user_id', 'dt', 'id'),  # keyset pagination of listings
+        Index('ix_entry_user_id_content_hash', 'user_id', 'content_hash'),  # deduplication of uploads
+    )
 
     id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, insert_default=uuid.uuid4)
     dt: Mapped[datetime.datetime] = mapped_column(DateTime, insert_default=datetime.datetime.now)
@@ -31,6 +47,7 @@ class EntryOrm(Base):
     user_id = mapped_column(ForeignKey('user.id'))
 
     atoms: Mapped[List['AtomOrm']] = relationship(back_populates='entry', cascade='all, delete-orphan')
+    rollups: Mapped[List['RollupOrm']] = relationship(back_populates='entry', cascade='all, delete-orphan')
     visualizations: Mapped[List['VisualizationOrm']] = relationship(
         back_populates='entry', cascade='all, delete-orphan'
     )
@@ -57,6 +74,20 @@ class EntryOrm(Base):
     review_time_mode: Mapped[int] = mapped_column(Integer)
     review_time_std: Mapped[float] = mapped_column(Float)
 
+    # Incremented on every change of atoms, a part of cache keys of visualization data
+    version: Mapped[int] = mapped_column(Integer, insert_default=1, server_default='1')
+
+    # SHA-256 of the uploaded file, used to deduplicate uploads
+    content_hash: Mapped[Optional[str]] = mapped_column(String)
+
+    # Atoms as an Arrow IPC file with compressed buffers, see `api.services.dump_atoms`
+    atoms_blob: Mapped[Optional[bytes]] = mapped_column(LargeBinary, deferred=True)
+    # All atoms are rows of the `atom` table as well, which isn't the case for entries ingested with `ATOMS_TABLE` off
+    atoms_table: Mapped[bool] = mapped_column(Boolean, insert_default=True, server_default='true')
+
+    # Mergeable state of summary fields (serialized `api.stats.Histogram` by field), used by incremental updates
+    summary_state: Mapped[Optional[Dict[str, Any]]] = mapped_column(JSONB, deferred=True)
+
 
 class AtomOrm(Base):
     __tablename__ = 'atom'
@@ -70,8 +101,24 @@ class AtomOrm(Base):
     merge_time: Mapped[int] = mapped_column(Integer)
 
 
+class RollupOrm(Base):
+    """Sums of measures of entry atoms by date buckets and team, see `api.services.rollup_atoms`"""
+
+    __tablename__ = 'rollup'
+
+    entry: Mapped['EntryOrm'] = relationship(back_populates='rollups')
+    entry_id = mapped_column(ForeignKey('entry.id'), primary_key=True)
+
+    resolution: Mapped[str] = mapped_column(String(), primary_key=True)
+    date: Mapped[datetime.date] = mapped_column(Date, primary_key=True)  # label of the bucket
+    team: Mapped[str] = mapped_column(String(), primary_key=True)
+    review_time: Mapped[int] = mapped_column(BigInteger)
+    merge_time: Mapped[int] = mapped_column(BigInteger)
+
+
 class VisualizationOrm(Base):
     __tablename__ = 'visualization'
+    __table_args__ = (Index('ix_visualization_dt_id', 'dt', 'id'),)  # keyset pagination of listings
 
     id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, insert_default=uuid.uuid4)
 
@@ -88,6 +135,7 @@ for field_name in SUMMARY_FIELDS:
     for suffix in SUMMARY_FUNCTIONS.keys():
         assert hasattr(EntryOrm, f'{field_name}_{suffix}')
 
-# check if the Atom orm model has all required fields
+# check if the Atom and Rollup orm models have all required fields
 for col in Columns:
     assert hasattr(AtomOrm, col)
+    assert hasattr(RollupOrm, col)
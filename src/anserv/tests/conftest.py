@@ -6,16 +6,18 @@ import pytest
 from fastapi.testclient import TestClient
 from httpx._auth import Auth
 from httpx._models import Request, Response
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
-from api.auth import get_password_hash
-from api.services import parse_uploaded_file
+from api.auth import get_password_hash, user_cache
+from api.services import entry_df_cache, parse_uploaded_file, rollup_atoms, vis_data_cache
 from app import app
 from conf import BASE_URL
 from const import ChartTypes
-from db.orm import EntryOrm, UserOrm, VisualizationOrm
+from db.orm import AtomOrm, EntryOrm, RollupOrm, UserOrm, VisualizationOrm
 from db.utils import Base, test_engine, test_session
-from vis.vis_types import AnyVisType, DateByTypeVis, DateResolution
+from vis.buckets import DateResolution
+from vis.vis_types import AnyVisType, DateByTypeVis
 
 
 class TokenAuth(Auth):
@@ -36,6 +38,9 @@ def api_client() -> TestClient:
 def db_session() -> Generator[Session, None, None]:
     Base.metadata.drop_all(test_engine)
     Base.metadata.create_all(test_engine)
+    entry_df_cache.clear()
+    vis_data_cache.clear()
+    user_cache.clear()
 
     with test_session() as session:
         yield session
@@ -82,8 +87,13 @@ def entry_factory(db_session: Session, user_factory: Callable[..., UserOrm]) ->
             )
 
         fp = io.BytesIO(csv_data.encode())
-        entry = parse_uploaded_file(fp, user.id)
+        entry, table = parse_uploaded_file(fp, user.id)
         db_session.add(entry)
+        db_session.flush()
+        db_session.execute(insert(AtomOrm), [{'entry_id': entry.id, **row} for row in table.to_pylist()])
+        db_session.execute(
+            insert(RollupOrm), [{'entry_id': entry.id, **row} for row in rollup_atoms(table).to_pylist()]
+        )
         db_session.commit()
         return entry
 
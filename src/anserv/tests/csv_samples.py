@@ -1,5 +1,14 @@
+import datetime
+import io
+import random
 from typing import Any, Dict, List, Tuple
 
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv
+
+from const import FileFormats
+
 VALID_SAMPLES: List[Tuple[str, Dict[str, Any]]] = [
     (  # basic
         """
@@ -82,4 +91,48 @@ review_time,team,date,merge_time
 0,Qwe,2023-01-01,0
 0,Qwe,2023-01-01
     """.strip(),
+    # Missing values
+    """
+review_time,team,date,merge_time
+0,Qwe,2023-01-01,
+    """.strip(),
+    # Negative values
+    """
+review_time,team,date,merge_time
+0,Qwe,2023-01-01,-1
+    """.strip(),
 ]
+
+
+def generate_csv(rows: int, teams: int = 20, seed: int = 0) -> bytes:
+    """Random valid CSV with unique (date, team) pairs, dates go back from 2023-01-01 as needed"""
+    rnd = random.Random(seed)
+    start = datetime.date(2023, 1, 1)
+    lines = ['review_time,team,date,merge_time']
+    for i in range(rows):
+        date = start - datetime.timedelta(days=i // teams)
+        lines.append(f'{rnd.randrange(100_000)},Team {i % teams},{date.isoformat()},{rnd.randrange(10_000)}')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def convert_csv(csv_data: bytes, file_format: FileFormats) -> bytes:
+    """Same data in another upload format, columnar ones keep types inferred by pyarrow, e.g. int64"""
+    if file_format == FileFormats.CSV:
+        return csv_data
+
+    sink = pa.BufferOutputStream()
+    if file_format in (FileFormats.CSV_GZIP, FileFormats.CSV_ZSTD):
+        with pa.CompressedOutputStream(sink, 'gzip' if file_format == FileFormats.CSV_GZIP else 'zstd') as stream:
+            stream.write(csv_data)
+        return bytes(sink.getvalue().to_pybytes())
+
+    table = csv.read_csv(io.BytesIO(csv_data))
+    if file_format == FileFormats.PARQUET:
+        pq.write_table(table, sink)
+    elif file_format == FileFormats.ARROW_FILE:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return bytes(sink.getvalue().to_pybytes())
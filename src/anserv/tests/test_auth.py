@@ -1,8 +1,14 @@
+import datetime
+import time
 from typing import Any, Callable
 
 import pytest
 from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+from sqlalchemy.orm import Session
 
+from api import auth, metrics
+from api.auth import create_access_token, get_password_hash, user_cache
 from db.orm import UserOrm
 
 from .conftest import TokenAuth
@@ -44,6 +50,25 @@ def test_auth_negative_no_user(api_client: TestClient, username: Any, password:
     assert response.status_code // 100 == 4  # don't care about specific code as long as it's 4xx
 
 
+def test_auth_rehash_deprecated(
+    api_client: TestClient, db_session: Session, monkeypatch: pytest.MonkeyPatch, user_factory: Callable[..., UserOrm]
+) -> None:
+    context = CryptContext(schemes=['bcrypt', 'md5_crypt'], deprecated='auto')
+    monkeypatch.setattr(auth, 'pwd_context', context)
+    user = user_factory()
+    user.hashed_password = context.handler('md5_crypt').hash('qwe123')
+    db_session.commit()
+
+    with api_client as client:
+        response = client.post('/auth/token/', data={'username': user.name, 'password': 'qwe123'})
+        second_response = client.post('/auth/token/', data={'username': user.name, 'password': 'qwe123'})
+
+    db_session.refresh(user)
+    assert response.status_code == 200
+    assert second_response.status_code == 200
+    assert context.identify(user.hashed_password) == 'bcrypt'
+
+
 def test_entries_listing_access(
     api_client: TestClient, get_auth: Callable[[str, str], TokenAuth], user_factory: Callable[..., UserOrm]
 ) -> None:
@@ -55,6 +80,59 @@ def test_entries_listing_access(
     assert response.status_code == 200
 
 
+def test_user_cache(
+    api_client: TestClient,
+    db_session: Session,
+    get_auth: Callable[[str, str], TokenAuth],
+    user_factory: Callable[..., UserOrm],
+) -> None:
+    user = user_factory()
+    auth = get_auth(user.name, 'qwe123')
+
+    with api_client as client:
+        before = metrics.snapshot()
+        assert client.get('/entries/', auth=auth).status_code == 200
+        assert client.get('/entries/', auth=auth).status_code == 200
+        after = metrics.snapshot()
+
+        user.hashed_password = get_password_hash('asd456')
+        db_session.commit()
+        assert user.name not in user_cache  # changed by the ORM, dropped right away
+        assert client.post('/auth/token/', data={'username': user.name, 'password': 'qwe123'}).status_code == 401
+        new_auth = get_auth(user.name, 'asd456')
+        assert client.get('/entries/', auth=new_auth).status_code == 200
+
+        db_session.delete(user)
+        db_session.flush()
+        # the user is still visible to other sessions, which cache it again until the deletion is committed
+        assert client.get('/entries/', auth=new_auth).status_code == 200
+        db_session.commit()
+        response = client.get('/entries/', auth=new_auth)
+
+    assert after['cache_auth_user_misses'] - before.get('cache_auth_user_misses', 0) == 1
+    assert after['cache_auth_user_hits'] - before.get('cache_auth_user_hits', 0) == 1
+    assert response.status_code == 401
+
+
+def test_token_cache(api_client: TestClient, user_factory: Callable[..., UserOrm]) -> None:
+    user = user_factory()
+    # `exp` is truncated to seconds, so the token is cached for 1-2s
+    auth = TokenAuth(create_access_token({'sub': user.name}, datetime.timedelta(seconds=2)))
+
+    with api_client as client:
+        before = metrics.snapshot()
+        assert client.get('/entries/', auth=auth).status_code == 200
+        assert client.get('/entries/', auth=auth).status_code == 200
+        after = metrics.snapshot()
+
+        time.sleep(3.2)  # the time `exp` is checked against is truncated as well
+        response = client.get('/entries/', auth=auth)
+
+    assert after['cache_auth_token_misses'] - before.get('cache_auth_token_misses', 0) == 1
+    assert after['cache_auth_token_hits'] - before.get('cache_auth_token_hits', 0) == 1
+    assert response.status_code == 401  # expired tokens are not served from the cache
+
+
 def test_entries_listing_no_auth(api_client: TestClient) -> None:
     with api_client as client:
         response = client.get('/entries/')
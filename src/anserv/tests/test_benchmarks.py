@@ -0,0 +1,181 @@
+"""Performance comparisons of optimized code paths against straightforward implementations.
+
+Excluded from the default run, use `pytest -m benchmark -s` to see the numbers.
+"""
+import asyncio
+import io
+import json
+import time
+import uuid
+from typing import Callable, List
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+from pydantic.json import pydantic_encoder
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from api.services import atoms_to_df, fetch_atoms, insert_atoms, parse_atoms, parse_uploaded_file, render_vis_data
+from const import MT2COL, Columns, MeasureTypes, VisDataFormats
+from db.orm import AtomOrm, EntryOrm, UserOrm
+from db.utils import async_session
+from vis.output import AnyOutputEntry, DateByTypeOutputEntry, ReviewMergeRatioOutputEntry, ReviewOverMergeOutputEntry
+from vis.vis_types import AnyVisType, DateByTypeVis, ReviewMergeRatioVis, ReviewOverMergeVis
+
+from .csv_samples import generate_csv
+
+pytestmark = pytest.mark.benchmark
+
+
+def _report(name: str, rows: int, seconds: float) -> None:
+    print(f'\n{name}: {rows} rows in {seconds:.2f}s, {rows / seconds:,.0f} rows/sec')
+
+
+async def _insert_orm(entry: EntryOrm, table: pa.Table) -> None:
+    # Previous implementation: an AtomOrm object per row flushed by the unit of work
+    for _, row in table.to_pandas(date_as_object=False).iterrows():
+        entry.atoms.append(
+            AtomOrm(
+                entry_id=entry.id,
+                team=row[Columns.TEAM],
+                date=row[Columns.DATE],
+                merge_time=row[Columns.MERGE_TIME],
+                review_time=row[Columns.REVIEW_TIME],
+            )
+        )
+    async with async_session() as db:
+        db.add(entry)
+        await db.commit()
+
+
+async def _insert_copy(entry: EntryOrm, table: pa.Table) -> None:
+    async with async_session() as db:
+        db.add(entry)
+        await db.flush()
+        await insert_atoms(db, entry.id, table)
+        await db.commit()
+
+
+@pytest.mark.parametrize('rows', [10_000, 100_000])
+def test_atoms_insert(user_factory: Callable[..., UserOrm], rows: int) -> None:
+    user = user_factory()
+    data = generate_csv(rows)
+
+    timings = {}
+    for name, insert in [('ORM', _insert_orm), ('COPY', _insert_copy)]:
+        entry, table = parse_uploaded_file(io.BytesIO(data), user.id)
+        entry.id = uuid.uuid4()
+
+        start = time.perf_counter()
+        asyncio.run(insert(entry, table))
+        timings[name] = time.perf_counter() - start
+        _report(f'Atoms insert, {name}', rows, timings[name])
+
+    assert timings['COPY'] < timings['ORM']
+
+
+def _read_sql(session: Session, entry_id: uuid.UUID) -> pd.DataFrame:
+    cols = [getattr(AtomOrm, col_name) for col_name in Columns]
+    stmt = select(*cols).where(AtomOrm.entry_id == entry_id)
+    df = pd.read_sql_query(stmt, session.connection(), parse_dates=[Columns.DATE])
+    assert isinstance(df, pd.DataFrame)
+    return df
+
+
+async def _fetch_read_sql(entry_id: uuid.UUID) -> pd.DataFrame:
+    # Previous implementation: pandas' sync reader over run_sync, rows come as python tuples
+    async with async_session() as db:
+        df = await db.run_sync(_read_sql, entry_id)
+        assert isinstance(df, pd.DataFrame)
+        return df
+
+
+async def _fetch_copy(entry_id: uuid.UUID) -> pd.DataFrame:
+    async with async_session() as db:
+        return atoms_to_df(await fetch_atoms(db, entry_id))
+
+
+@pytest.mark.parametrize('rows', [10_000, 100_000, 1_000_000])
+def test_atoms_fetch(user_factory: Callable[..., UserOrm], rows: int) -> None:
+    user = user_factory()
+    entry, table = parse_uploaded_file(io.BytesIO(generate_csv(rows)), user.id)
+    asyncio.run(_insert_copy(entry, table))
+
+    timings = {}
+    for name, fetch in [('read_sql', _fetch_read_sql), ('COPY', _fetch_copy)]:
+        start = time.perf_counter()
+        df = asyncio.run(fetch(entry.id))
+        timings[name] = time.perf_counter() - start
+        assert len(df) == rows
+        _report(f'Atoms fetch, {name}', rows, timings[name])
+
+    assert timings['COPY'] < timings['read_sql']
+
+
+def _output_loops(options: AnyVisType, df: pd.DataFrame) -> List[AnyOutputEntry]:
+    # Previous implementation: an output entry validated per row of the aggregated frame or per atom
+    for filter in options.filters:
+        df = filter.apply(df)
+
+    out: List[AnyOutputEntry] = []
+    if isinstance(options, ReviewOverMergeVis):
+        for _, row in df.iterrows():
+            out.append(
+                ReviewOverMergeOutputEntry(
+                    merge_value=row[Columns.MERGE_TIME],
+                    review_value=row[Columns.REVIEW_TIME],
+                    team=row[Columns.TEAM],
+                    date=row[Columns.DATE],
+                )
+            )
+        return out
+
+    aggregation = options.aggregation()
+    assert aggregation is not None
+    grouped = aggregation.apply(df)
+    for mt in MeasureTypes:
+        for indexes, value in grouped[MT2COL[mt]].items():
+            if isinstance(options, DateByTypeVis):
+                assert isinstance(indexes, tuple)  # typing
+                idate, team = indexes
+                out.append(DateByTypeOutputEntry(date=idate.date(), value=value, type=mt, team=team))
+            else:
+                assert isinstance(indexes, str)  # typing
+                out.append(ReviewMergeRatioOutputEntry(team=indexes, type=mt, value=value))
+    return out
+
+
+def _render_loops(options: AnyVisType, df: pd.DataFrame) -> bytes:
+    items = _output_loops(options, df)
+    return json.dumps({'data': [item.dict() for item in items]}, default=pydantic_encoder).encode()
+
+
+def _render_frame(options: AnyVisType, df: pd.DataFrame) -> bytes:
+    return render_vis_data(options, df, VisDataFormats.ROWS)
+
+
+@pytest.mark.parametrize(
+    'options',
+    [
+        DateByTypeVis(chart_type='line', date_resolution='day'),
+        ReviewOverMergeVis(chart_type='scatter'),
+        ReviewMergeRatioVis(chart_type='scatter'),
+    ],
+)
+@pytest.mark.parametrize('rows', [10_000, 1_000_000])
+def test_vis_render(options: AnyVisType, rows: int) -> None:
+    table, _ = parse_atoms(io.BytesIO(generate_csv(rows)))
+    df = atoms_to_df(table)
+
+    timings = {}
+    outputs = {}
+    for name, render in [('loops', _render_loops), ('frame', _render_frame)]:
+        start = time.perf_counter()
+        outputs[name] = render(options, df)
+        timings[name] = time.perf_counter() - start
+        _report(f'Vis render, {options.vis_type.value}, {name}', rows, timings[name])
+
+    assert json.loads(outputs['frame']) == json.loads(outputs['loops'])
+    if not isinstance(options, ReviewMergeRatioVis):  # a couple of entries per team, aggregation dominates
+        assert timings['frame'] < timings['loops']
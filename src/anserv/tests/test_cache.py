@@ -0,0 +1,166 @@
+import asyncio
+from pathlib import Path
+from typing import Awaitable, Callable, List
+
+import pytest
+
+from api import metrics
+from api.cache import DiskCache, LRUCache
+
+
+def make_loader(calls: List[str], value: str, delay: float = 0) -> Callable[[], Awaitable[str]]:
+    async def load() -> str:
+        calls.append(value)
+        await asyncio.sleep(delay)
+        return value
+
+    return load
+
+
+def test_lru_eviction() -> None:
+    cache: LRUCache[str, str] = LRUCache('test_eviction', max_size=3, sizeof=len)
+    calls: List[str] = []
+
+    async def run() -> None:
+        await cache.get_or_load('a', make_loader(calls, 'a'))
+        await cache.get_or_load('b', make_loader(calls, 'bb'))
+        await cache.get_or_load('a', make_loader(calls, 'a'))  # hit, "b" becomes the least recently used
+        await cache.get_or_load('c', make_loader(calls, 'c'))  # evicts "b"
+        await cache.get_or_load('a', make_loader(calls, 'a'))
+        await cache.get_or_load('b', make_loader(calls, 'bb'))
+        await cache.get_or_load('d', make_loader(calls, 'dddd'))  # too large, not cached
+
+    asyncio.run(run())
+    assert calls == ['a', 'bb', 'c', 'bb', 'dddd']
+    assert cache.size <= 3
+
+
+def test_lru_item_count() -> None:
+    cache: LRUCache[str, str] = LRUCache('test_item_count', max_size=2)
+    calls: List[str] = []
+
+    async def run() -> None:
+        await cache.get_or_load('a', make_loader(calls, 'a' * 100))
+        await cache.get_or_load('b', make_loader(calls, 'b'))
+        await cache.get_or_load('c', make_loader(calls, 'c'))  # evicts "a"
+        await cache.get_or_load('a', make_loader(calls, 'a'))
+
+    asyncio.run(run())
+    assert calls == ['a' * 100, 'b', 'c', 'a']
+    assert cache.size == 2
+    snapshot = metrics.snapshot()
+    assert snapshot['cache_test_item_count_items'] == 2
+    assert 'cache_test_item_count_bytes' not in snapshot
+
+
+def test_lru_coalesced_misses() -> None:
+    cache: LRUCache[str, str] = LRUCache('test_coalesced', max_size=100, sizeof=len)
+    calls: List[str] = []
+
+    async def run() -> List[str]:
+        load = make_loader(calls, 'value', delay=0.01)
+        return await asyncio.gather(*(cache.get_or_load('key', load) for _ in range(5)))
+
+    assert asyncio.run(run()) == ['value'] * 5
+    assert calls == ['value']
+
+
+def test_lru_invalidate_while_loading() -> None:
+    cache: LRUCache[str, str] = LRUCache('test_invalidate', max_size=100, sizeof=len)
+    calls: List[str] = []
+
+    async def run() -> str:
+        task = asyncio.create_task(cache.get_or_load('key', make_loader(calls, 'old', delay=0.01)))
+        await asyncio.sleep(0)
+        cache.invalidate('key')
+        assert await task == 'old'
+        return await cache.get_or_load('key', make_loader(calls, 'new'))
+
+    assert asyncio.run(run()) == 'new'
+    assert calls == ['old', 'new']
+
+
+def test_lru_failed_load() -> None:
+    cache: LRUCache[str, str] = LRUCache('test_failed', max_size=100, sizeof=len)
+
+    async def fail() -> str:
+        await asyncio.sleep(0.01)
+        raise ValueError()
+
+    async def run() -> None:
+        results = await asyncio.gather(*(cache.get_or_load('key', fail) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(res, ValueError) for res in results)
+
+    asyncio.run(run())
+    assert cache.size == 0
+
+
+def test_lru_ttl() -> None:
+    cache: LRUCache[str, str] = LRUCache('test_ttl', max_size=100, sizeof=len, ttl=0.05)
+    calls: List[str] = []
+
+    async def run() -> None:
+        await cache.get_or_load('key', make_loader(calls, 'old'))
+        assert await cache.get_or_load('key', make_loader(calls, 'other')) == 'old'
+        await asyncio.sleep(0.06)
+        assert await cache.get_or_load('key', make_loader(calls, 'new')) == 'new'
+
+    asyncio.run(run())
+    assert calls == ['old', 'new']
+    assert cache.size == 3
+    assert metrics.snapshot()['cache_test_ttl_hit_ratio'] == pytest.approx(1 / 3)
+
+
+def test_disk_cache(tmp_path: Path) -> None:
+    cache = DiskCache('test_disk', max_size=10, directory=str(tmp_path))
+    calls: List[bytes] = []
+
+    def make_bytes_loader(value: bytes) -> Callable[[], Awaitable[bytes]]:
+        async def load() -> bytes:
+            calls.append(value)
+            return value
+
+        return load
+
+    async def run() -> None:
+        assert await cache.get_or_load(('a', '1'), make_bytes_loader(b'first')) == b'first'
+        assert await cache.get_or_load(('a', '1'), make_bytes_loader(b'other')) == b'first'
+        await cache.get_or_load(('b', '1'), make_bytes_loader(b'second'))  # evicts ('a', '1')
+        cache.invalidate_where(lambda key: key[0] == 'b')
+        await cache.flush()
+
+    asyncio.run(run())
+    assert calls == [b'first', b'second']
+    assert cache.size == 0
+    assert not any(path.is_file() for path in tmp_path.rglob('*'))
+
+    cache.close()
+    assert not any(tmp_path.iterdir())
+
+
+def test_disk_cache_removed_file(tmp_path: Path) -> None:
+    cache = DiskCache('test_disk_removed', max_size=100, directory=str(tmp_path))
+    calls: List[bytes] = []
+
+    def make_bytes_loader(value: bytes) -> Callable[[], Awaitable[bytes]]:
+        async def load() -> bytes:
+            calls.append(value)
+            return value
+
+        return load
+
+    async def run() -> None:
+        await cache.get_or_load(('a',), make_bytes_loader(b'old'))
+        for path in tmp_path.rglob('*'):
+            if path.is_file():
+                path.unlink()
+        assert await cache.get_or_load(('a',), make_bytes_loader(b'new')) == b'new'
+        assert await cache.get_or_load(('a',), make_bytes_loader(b'other')) == b'new'
+
+    asyncio.run(run())
+    assert calls == [b'old', b'new']
+    assert cache.size == 3
+    snapshot = metrics.snapshot()
+    assert snapshot['cache_test_disk_removed_misses'] == 2
+    assert snapshot['cache_test_disk_removed_hits'] == 1
+    cache.close()
@@ -0,0 +1,32 @@
+import asyncio
+import threading
+
+import pytest
+
+from api import metrics
+from api.executors import ExecutorBusy, ExecutorTypes, PoolExecutor
+
+
+def test_executor_max_queue() -> None:
+    executor = PoolExecutor('test_busy', ExecutorTypes.THREAD, workers=1, max_queue=1)
+    release = threading.Event()
+
+    async def run() -> None:
+        running = asyncio.ensure_future(executor.run(release.wait, 5))
+        queued = asyncio.ensure_future(executor.run(lambda: 'queued'))
+        await asyncio.sleep(0.05)
+        assert executor.queue_depth == 1
+        with pytest.raises(ExecutorBusy):
+            await executor.run(lambda: 'rejected')
+
+        release.set()
+        assert await running is True
+        assert await queued == 'queued'
+
+    asyncio.run(run())
+    executor.shutdown()
+
+    snapshot = metrics.snapshot()
+    assert snapshot['executor_test_busy_calls'] == 2
+    assert snapshot['executor_test_busy_rejected'] == 1
+    assert snapshot['executor_test_busy_queue_seconds'] >= 0.05  # the second call waited for the first one
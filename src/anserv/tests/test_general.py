@@ -1,5 +1,12 @@
+from typing import Callable
+
+import pytest
 from fastapi.testclient import TestClient
 
+from db.orm import UserOrm
+
+from .conftest import TokenAuth
+
 
 def test_root(api_client: TestClient) -> None:
     with api_client as client:
@@ -13,3 +20,28 @@ def test_swagger(api_client: TestClient) -> None:
         response = client.get('/openapi.json')
 
     assert response.status_code == 200
+    schema = response.json()
+    for path, model_name in [('/entries/', 'SparseEntrySummary'), ('/vis/', 'SparseVisualization')]:
+        page = schema['paths'][path]['get']['responses']['200']
+        assert 'Link' in page['headers']
+        assert page['content']['application/json']['schema']['items']['$ref'].endswith(model_name)
+    assert 'required' not in schema['components']['schemas']['SparseEntrySummary']
+
+
+def test_metrics(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    user_factory: Callable[..., UserOrm],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    user_factory()
+    with api_client as client:
+        response = client.get('/metrics/', auth=get_auth('user', 'qwe123'))
+        anonymous_response = client.get('/metrics/')
+        monkeypatch.setattr('app.METRICS_PUBLIC', True)
+        public_response = client.get('/metrics/')
+
+    assert response.status_code == 200
+    assert 'executor_vis_queue_depth' in response.json()
+    assert anonymous_response.status_code == 401
+    assert public_response.status_code == 200
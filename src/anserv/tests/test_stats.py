@@ -0,0 +1,50 @@
+import math
+import random
+from typing import List
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from api.stats import Histogram
+from const import SUMMARY_FUNCTIONS
+
+rnd = random.Random(0)
+
+
+@pytest.mark.parametrize(
+    'values',
+    [
+        [0],
+        [5, 5],
+        [1, 2, 3, 4],
+        [0, 144299, 0, 77],
+        [3, 1, 3, 1, 2],  # mode ties
+        [rnd.randrange(1000) for _ in range(1001)],
+        [rnd.randrange(100_000) for _ in range(10_000)],
+    ],
+)
+def test_histogram_summary(values: List[int]) -> None:
+    summary = Histogram.from_array(pa.chunked_array([values], type=pa.int32())).summary()
+
+    series = pd.Series(values, dtype='int32')
+    for suffix, func in SUMMARY_FUNCTIONS.items():
+        expected = func(series)
+        if isinstance(expected, float) and math.isnan(expected):
+            assert math.isnan(summary[suffix])
+        else:
+            assert summary[suffix] == pytest.approx(expected, rel=1e-12), suffix
+
+
+def test_histogram_merge() -> None:
+    values = [rnd.randrange(100) for _ in range(1000)]
+    removed = values[:100]
+    added = [rnd.randrange(50, 150) for _ in range(200)]
+
+    def histogram(values: List[int]) -> Histogram:
+        return Histogram.from_array(pa.chunked_array([values], type=pa.int32()))
+
+    merged = Histogram.from_dict(histogram(values).to_dict()) - histogram(removed) + histogram(added)
+    expected = histogram(values[100:] + added)
+    assert merged.to_dict() == expected.to_dict()
+    assert merged.summary() == expected.summary()
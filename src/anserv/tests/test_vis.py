@@ -1,11 +1,19 @@
+import io
+import uuid
+from pathlib import Path
 from typing import Any, Callable
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import select
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
 
+from api import metrics
+from api.cache import DiskCache
+from api.executors import ExecutorTypes, PoolExecutor
+from api.services import dump_atoms, invalidate_entry_caches, parse_atoms, vis_data_cache
 from db.orm import EntryOrm, UserOrm, VisualizationOrm
+from vis.vis_types import ReviewOverMergeVis
 
 from .conftest import TokenAuth
 
@@ -51,6 +59,27 @@ def test_vis_listing_filter(
     assert response.json()[0]['id'] == str(vis.id)
 
 
+def test_vis_listing_pages(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    vis_factory: Callable[..., VisualizationOrm],
+    entry_factory: Callable[..., EntryOrm],
+    user_factory: Callable[..., UserOrm],
+) -> None:
+    user = user_factory('user', 'qwe123')
+    entry = entry_factory(user=user)
+    for _ in range(3):
+        vis_factory(entry=entry)
+
+    with api_client as client:
+        listing = client.get('/vis/', auth=get_auth('user', 'qwe123')).json()
+        first = client.get('/vis/?limit=2&fields=id,options', auth=get_auth('user', 'qwe123'))
+        second = client.get(first.links['next']['url'], auth=get_auth('user', 'qwe123'))
+
+    assert first.json() + second.json() == [{'id': vis['id'], 'options': vis['options']} for vis in listing]
+    assert 'next' not in second.links
+
+
 def test_vis_listing_other(
     api_client: TestClient,
     get_auth: Callable[[str, str], TokenAuth],
@@ -81,6 +110,161 @@ def test_vis_detail(
     assert 'data' in response.json()
 
 
+def test_vis_detail_process_executor(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    vis_factory: Callable[..., VisualizationOrm],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    vis = vis_factory(vis_type=ReviewOverMergeVis(chart_type='scatter'))
+    auth = get_auth('user', 'qwe123')
+    executor = PoolExecutor('test_process', ExecutorTypes.PROCESS, 1)
+    with api_client as client:
+        expected = client.get(f'/vis/{vis.id}/', auth=auth).json()
+
+        vis_data_cache.clear()
+        monkeypatch.setattr('app.vis_executor', executor)
+        try:
+            response = client.get(f'/vis/{vis.id}/', auth=auth)
+        finally:
+            executor.shutdown()
+
+    assert response.json() == expected
+    assert metrics.snapshot()['executor_test_process_calls'] == 1
+
+
+def test_vis_detail_changed_by_other_process(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    vis_factory: Callable[..., VisualizationOrm],
+    db_session: Session,
+) -> None:
+    vis = vis_factory(vis_type=ReviewOverMergeVis(chart_type='scatter'))
+    table, _ = parse_atoms(io.BytesIO(b'review_time,team,date,merge_time\n1,New,2023-01-01,2\n'))
+    with api_client as client:
+        before = client.get(f'/vis/{vis.id}/', auth=get_auth('user', 'qwe123')).json()
+
+        # caches of this process are not invalidated, the version tells that atoms are changed
+        db_session.execute(
+            update(EntryOrm)
+            .where(EntryOrm.id == vis.entry_id)
+            .values(atoms_blob=dump_atoms(table), version=EntryOrm.version + 1)
+        )
+        db_session.commit()
+        after = client.get(f'/vis/{vis.id}/', auth=get_auth('user', 'qwe123')).json()
+
+    assert len(before['data']) > 1
+    assert after['data'] == [{'merge_value': 2, 'review_value': 1, 'team': 'New', 'date': '2023-01-01'}]
+
+
+def test_vis_detail_atoms_table_enabled_later(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    user_factory: Callable[..., UserOrm],
+    db_session: Session,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    user_factory()
+    auth = get_auth('user', 'qwe123')
+    csv_data = b'review_time,team,date,merge_time\n1,Qwe,2023-01-01,2\n3,Asd,2023-01-02,4\n'
+    monkeypatch.setattr('api.services.ATOMS_TABLE', False)
+    with api_client as client:
+        response = client.post('/entries/', auth=auth, files={'payload': io.BytesIO(csv_data)})
+        assert response.status_code == 201
+    entry_id = response.json()['id']
+
+    options = ReviewOverMergeVis(chart_type='scatter', filters=[{'filter_type': 'teams', 'teams': ['Qwe']}])
+    vis = VisualizationOrm(id=uuid.uuid4(), entry_id=entry_id, options=options)
+    db_session.add(vis)
+    db_session.commit()
+
+    # atoms of the entry are in its blob only, filters can't be pushed down to the atom table
+    monkeypatch.setattr('api.services.ATOMS_TABLE', True)
+    with api_client as client:
+        response = client.get(f'/vis/{vis.id}/', auth=auth)
+
+    assert response.json()['data'] == [{'merge_value': 2, 'review_value': 1, 'team': 'Qwe', 'date': '2023-01-01'}]
+
+
+def test_vis_detail_atoms_table(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    vis_factory: Callable[..., VisualizationOrm],
+    db_session: Session,
+) -> None:
+    vis = vis_factory()
+    with api_client as client:
+        from_blob = client.get(f'/vis/{vis.id}/', auth=get_auth('user', 'qwe123')).json()
+
+        # entries without atoms blob fall back to rows of the atom table
+        db_session.execute(update(EntryOrm).where(EntryOrm.id == vis.entry_id).values(atoms_blob=None))
+        db_session.commit()
+        invalidate_entry_caches(vis.entry_id)
+        from_table = client.get(f'/vis/{vis.id}/', auth=get_auth('user', 'qwe123')).json()
+
+    assert from_blob['data']
+    assert from_blob == from_table
+
+
+def test_vis_detail_cache(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    vis_factory: Callable[..., VisualizationOrm],
+) -> None:
+    vis = vis_factory()
+    auth = get_auth('user', 'qwe123')
+    with api_client as client:
+        before = client.get('/metrics/', auth=auth).json()
+        first = client.get(f'/vis/{vis.id}/', auth=auth).json()
+        second = client.get(f'/vis/{vis.id}/', auth=auth).json()
+        after = client.get('/metrics/', auth=auth).json()
+
+        # appended atoms are visible right away
+        response = client.post(
+            f'/entries/{vis.entry_id}/append/',
+            auth=auth,
+            files={'payload': io.BytesIO(b'review_time,team,date,merge_time\n1,New,2023-01-01,1\n')},
+        )
+        assert response.status_code == 200
+        third = client.get(f'/vis/{vis.id}/', auth=auth).json()
+
+    assert first == second
+    assert after['cache_vis_data_misses'] - before.get('cache_vis_data_misses', 0) == 1
+    assert after['cache_vis_data_hits'] - before.get('cache_vis_data_hits', 0) == 1
+    assert any(item['team'] == 'New' for item in third['data'])
+
+
+def test_vis_detail_disk_cache(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    vis_factory: Callable[..., VisualizationOrm],
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    """Same as with VIS_CACHE_BACKEND=disk, files might be removed by a cleaner of temporary files"""
+    cache = DiskCache('test_vis_disk', 1024 * 1024, str(tmp_path))
+    monkeypatch.setattr('app.vis_data_cache', cache)
+    monkeypatch.setattr('api.services.vis_data_cache', cache)
+    vis = vis_factory()
+    auth = get_auth('user', 'qwe123')
+    try:
+        with api_client as client:
+            first = client.get(f'/vis/{vis.id}/', auth=auth)
+            files = [path for path in tmp_path.rglob('*') if path.is_file()]
+            assert len(files) == 1
+            files[0].unlink()
+            second = client.get(f'/vis/{vis.id}/', auth=auth)
+            third = client.get(f'/vis/{vis.id}/', auth=auth)
+    finally:
+        cache.close()
+
+    assert first.status_code == second.status_code == third.status_code == 200
+    assert first.json() == second.json() == third.json()
+    snapshot = metrics.snapshot()
+    assert snapshot['cache_test_vis_disk_misses'] == 2
+    assert snapshot['cache_test_vis_disk_hits'] == 1
+
+
 def test_vis_remove(
     api_client: TestClient,
     get_auth: Callable[[str, str], TokenAuth],
@@ -144,6 +328,27 @@ def test_vis_unshare(
     assert not db_session.query(VisualizationOrm.is_public).scalar()
 
 
+def test_vis_unshare_cached(
+    api_client: TestClient,
+    get_auth: Callable[[str, str], TokenAuth],
+    vis_factory: Callable[..., VisualizationOrm],
+) -> None:
+    vis = vis_factory(is_public=True)
+    auth = get_auth('user', 'qwe123')
+    with api_client as client:
+        assert client.get(f'/vis/{vis.id}/').status_code == 200  # data is cached now
+
+        response = client.delete(f'/vis/{vis.id}/share/', auth=auth)
+        assert response.status_code // 100 == 2
+
+        assert client.get(f'/vis/{vis.id}/').status_code == 404
+        response = client.get(f'/vis/{vis.id}/', auth=auth)
+
+    assert response.status_code == 200
+    assert response.json()['is_public'] is False
+    assert response.json()['data']
+
+
 @pytest.mark.parametrize(
     'auth_factory',
     [
@@ -1,11 +1,32 @@
-from typing import Any, Callable, Dict, Type
+import asyncio
+import datetime
+import io
+import json
+from typing import Any, Callable, Dict, List, Optional, Type
 
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 from fastapi.testclient import TestClient
 
+from api.services import (
+    ATOMS_ORDER,
+    aggregate_for_vis,
+    atoms_to_df,
+    load_atoms,
+    negotiate_vis_data_format,
+    parse_atoms,
+)
+from const import VisDataFormats
 from db.orm import EntryOrm, VisualizationOrm
+from db.utils import async_session
+from vis.filters import AnyDataFilter, DateRangeDataFilter, TeamsDataFilter, apply_filters
+from vis.sampling import SamplingStrategies
 from vis.vis_types import AnyVisType, DateByTypeVis, ReviewMergeRatioVis, ReviewOverMergeVis
 
+from .csv_samples import generate_csv
+
 CSV_DATA = """
 team,date,merge_time,review_time
 Qwe,2023-01-01,10,10
@@ -92,3 +113,271 @@ def test_date_by_type_vis(
 
     assert len(data) == expected_len
     assert expected_item in data
+
+
+WHOLE_WEEKS = {'filter_type': 'date-range', 'start_date': '2022-08-02', 'end_date': '2022-11-28'}  # Tue to Mon
+WHOLE_MONTHS = {'filter_type': 'date-range', 'start_date': '2022-08-01', 'end_date': '2022-11-30'}
+
+
+@pytest.mark.parametrize(
+    'options,from_rollups',
+    [
+        (DateByTypeVis(chart_type='bar', date_resolution='day'), False),
+        (DateByTypeVis(chart_type='bar', date_resolution='week'), True),
+        (DateByTypeVis(chart_type='bar', date_resolution='month'), True),
+        (
+            DateByTypeVis(
+                chart_type='bar',
+                date_resolution='week',
+                filters=[
+                    {'filter_type': 'teams', 'teams': ['Team 2', 'Team 7']},
+                    {'filter_type': 'date-range', 'start_date': '2022-08-03', 'end_date': '2022-11-29'},
+                ],
+            ),
+            False,
+        ),
+        (
+            DateByTypeVis(
+                chart_type='bar',
+                date_resolution='week',
+                filters=[{'filter_type': 'teams', 'teams': ['Team 2', 'Team 7']}, WHOLE_WEEKS],
+            ),
+            True,
+        ),
+        (DateByTypeVis(chart_type='bar', date_resolution='month', filters=[WHOLE_MONTHS]), True),
+        (DateByTypeVis(chart_type='bar', date_resolution='month', filters=[WHOLE_WEEKS]), False),
+        (ReviewMergeRatioVis(chart_type='scatter'), True),
+        (ReviewMergeRatioVis(chart_type='scatter', filters=[{'filter_type': 'teams', 'teams': []}]), True),
+        (ReviewMergeRatioVis(chart_type='scatter', filters=[WHOLE_WEEKS]), True),
+        (
+            ReviewMergeRatioVis(
+                chart_type='scatter', filters=[{'filter_type': 'date-range', 'start_date': '2022-08-03'}]
+            ),
+            False,
+        ),
+    ],
+)
+def test_sql_aggregation(
+    entry_factory: Callable[..., EntryOrm],
+    options: AnyVisType,
+    from_rollups: bool,
+) -> None:
+    entry = entry_factory(csv_data=generate_csv(2000, teams=10).decode())  # 200 days
+    assert entry.atoms_blob is not None
+
+    async def aggregate() -> Optional[pd.DataFrame]:
+        async with async_session() as db:
+            return await aggregate_for_vis(entry, db, options)
+
+    aggregated = asyncio.run(aggregate())
+    assert aggregated is not None
+    assert options.apply_aggregated(aggregated) == options.apply(atoms_to_df(load_atoms(entry.atoms_blob)))
+
+    entry.atoms_table = False  # atoms are in the blob only, so only rollups can be aggregated then
+    assert (asyncio.run(aggregate()) is not None) == from_rollups
+
+
+@pytest.mark.parametrize(
+    'vis_type',
+    [
+        DateByTypeVis(chart_type='line', date_resolution='week'),
+        ReviewOverMergeVis(chart_type='scatter'),
+        ReviewMergeRatioVis(chart_type='scatter'),
+    ],
+)
+@pytest.mark.parametrize('sql_aggregation', [True, False])
+def test_vis_columnar(
+    api_client: TestClient,
+    entry_factory: Callable[..., EntryOrm],
+    vis_factory: Callable[..., VisualizationOrm],
+    monkeypatch: pytest.MonkeyPatch,
+    vis_type: AnyVisType,
+    sql_aggregation: bool,
+) -> None:
+    monkeypatch.setattr('api.services.VIS_SQL_AGGREGATION', sql_aggregation)
+    vis = vis_factory(entry=entry_factory(csv_data=CSV_DATA), vis_type=vis_type, is_public=True)
+
+    with api_client as client:
+        rows = client.get(f'/vis/{vis.id}/').json()
+        response = client.get(f'/vis/{vis.id}/?format=columnar')
+
+    assert response.status_code == 200
+    columnar = response.json()
+    assert 'data' not in columnar
+    assert columnar['options'] == rows['options']
+    assert columnar['dictionaries']['team'] == ['Asd', 'Qwe']
+
+    dictionaries = columnar['dictionaries']
+    columns = {
+        name: [dictionaries[name][code] for code in values] if name in dictionaries else values
+        for name, values in columnar['columns'].items()
+    }
+    assert [dict(zip(columns, values)) for values in zip(*columns.values())] == rows['data']
+
+
+@pytest.mark.parametrize(
+    'accept, expected',
+    [
+        (None, None),
+        ('application/vnd.apache.arrow.stream', VisDataFormats.ARROW_STREAM),
+        ('application/x-ndjson, application/x-parquet', VisDataFormats.NDJSON),
+        ('application/json, application/vnd.apache.arrow.stream;q=0.1', None),
+        ('application/json;q=0.5, application/vnd.apache.arrow.stream', VisDataFormats.ARROW_STREAM),
+        ('application/x-ndjson;q=0, */*', None),
+        ('application/x-ndjson;q=0', None),
+        ('text/csv, application/x-parquet; Q=0.3, */*;q=0.2', VisDataFormats.PARQUET),
+        ('application/x-parquet;q=invalid', None),
+    ],
+)
+def test_negotiate_vis_data_format(accept: Optional[str], expected: Optional[VisDataFormats]) -> None:
+    assert negotiate_vis_data_format(accept) == expected
+
+
+@pytest.mark.parametrize(
+    'vis_type',
+    [
+        DateByTypeVis(chart_type='line', date_resolution='week'),
+        ReviewOverMergeVis(chart_type='scatter'),
+        ReviewMergeRatioVis(chart_type='scatter'),
+    ],
+)
+@pytest.mark.parametrize(
+    'media_type,read',
+    [
+        ('application/vnd.apache.arrow.stream', lambda content: pa.ipc.open_stream(content).read_all()),
+        ('application/vnd.apache.parquet', lambda content: pq.read_table(pa.BufferReader(content))),
+    ],
+)
+def test_vis_binary(
+    api_client: TestClient,
+    entry_factory: Callable[..., EntryOrm],
+    vis_factory: Callable[..., VisualizationOrm],
+    vis_type: AnyVisType,
+    media_type: str,
+    read: Callable[[bytes], pa.Table],
+) -> None:
+    vis = vis_factory(entry=entry_factory(csv_data=CSV_DATA), vis_type=vis_type, is_public=True)
+
+    with api_client as client:
+        rows = client.get(f'/vis/{vis.id}/').json()
+        response = client.get(f'/vis/{vis.id}/', headers={'Accept': f'text/csv, {media_type};q=0.9, */*;q=0.1'})
+
+    assert response.status_code == 200
+    assert response.headers['content-type'] == media_type
+    table = read(response.content)
+    assert pa.types.is_dictionary(table.schema.field('team').type)
+
+    metadata = json.loads(table.schema.metadata[b'visualization'])
+    assert metadata == {key: value for key, value in rows.items() if key != 'data'}
+
+    data = [
+        {key: value.isoformat() if isinstance(value, datetime.date) else value for key, value in row.items()}
+        for row in table.to_pylist()
+    ]
+    assert data == rows['data']
+
+
+@pytest.mark.parametrize('sampling', list(SamplingStrategies))
+def test_review_over_merge_sampling(sampling: SamplingStrategies) -> None:
+    table, _ = parse_atoms(io.BytesIO(generate_csv(10_000, teams=10)))
+    df = atoms_to_df(table)
+    df = df[(df['team'] != 'Team 0') | (df['date'] > '2022-12-20')]  # a small team, 12 atoms
+    team_sizes = df['team'].value_counts()
+
+    vis = ReviewOverMergeVis(chart_type='scatter', max_points=500, sampling=sampling)
+    frame = vis.apply_frame(df)
+    assert len(frame) <= 500
+    assert frame.equals(vis.apply_frame(df))  # reproducible
+    assert vis.apply(df) == ReviewOverMergeVis(chart_type='scatter', sampling=sampling).apply(vis.downsample(df))
+
+    if sampling == SamplingStrategies.GRID:
+        counts = frame.groupby('team')['count'].sum()
+        assert counts.equals(team_sizes.reindex(counts.index))  # every atom is in some cell
+    else:
+        assert list(frame.columns) == ['merge_value', 'review_value', 'team', 'date']  # atoms have no counts
+        atoms = df.rename(columns={'merge_time': 'merge_value', 'review_time': 'review_value'})
+        assert len(frame.merge(atoms)) == len(frame)  # samples are atoms
+    if sampling == SamplingStrategies.STRATIFIED:
+        counts = frame['team'].value_counts()
+        assert counts['Team 0'] == 12
+        assert counts.drop('Team 0').min() >= 48  # (500 - 12) / 9 atoms of every other team
+
+    not_sampled = ReviewOverMergeVis(chart_type='scatter', max_points=len(df), sampling=sampling).apply_frame(df)
+    if sampling == SamplingStrategies.GRID:
+        assert not_sampled['count'].eq(1).all()
+    else:
+        assert not_sampled.equals(ReviewOverMergeVis(chart_type='scatter').apply_frame(df))
+
+
+@pytest.mark.parametrize('sampling', list(SamplingStrategies))
+def test_review_over_merge_sampling_many_teams(sampling: SamplingStrategies) -> None:
+    df = atoms_to_df(parse_atoms(io.BytesIO(generate_csv(1000, teams=50)))[0])
+    frame = ReviewOverMergeVis(chart_type='scatter', max_points=20, sampling=sampling).apply_frame(df)
+    assert len(frame) == 20
+    if sampling != SamplingStrategies.UNIFORM:
+        assert frame['team'].nunique() == 20  # a point of every sampled team
+
+
+@pytest.mark.parametrize(
+    'vis_type',
+    [
+        DateByTypeVis(chart_type='line', date_resolution='week'),
+        ReviewOverMergeVis(chart_type='scatter'),
+        ReviewMergeRatioVis(chart_type='scatter'),
+    ],
+)
+def test_vis_ndjson(
+    api_client: TestClient,
+    entry_factory: Callable[..., EntryOrm],
+    vis_factory: Callable[..., VisualizationOrm],
+    monkeypatch: pytest.MonkeyPatch,
+    vis_type: AnyVisType,
+) -> None:
+    monkeypatch.setattr('app.VIS_STREAM_CHUNK_ROWS', 3)
+    vis = vis_factory(entry=entry_factory(csv_data=CSV_DATA), vis_type=vis_type, is_public=True)
+
+    with api_client as client:
+        rows = client.get(f'/vis/{vis.id}/').json()
+        with client.stream('GET', f'/vis/{vis.id}/', headers={'Accept': 'application/x-ndjson'}) as response:
+            assert response.status_code == 200
+            assert response.headers['content-type'] == 'application/x-ndjson'
+            lines = [json.loads(line) for line in response.iter_lines()]
+
+    assert lines[0] == {key: value for key, value in rows.items() if key != 'data'}
+    assert lines[1:] == rows['data']
+
+
+@pytest.mark.parametrize(
+    'filters',
+    [
+        [],
+        [TeamsDataFilter(teams=[])],
+        [TeamsDataFilter(teams=['Team 2', 'Team 7', 'Unknown'])],
+        [DateRangeDataFilter(start_date='2022-11-03')],
+        [DateRangeDataFilter(start_date='2022-11-03', end_date='2022-12-01')],
+        [DateRangeDataFilter(start_date='2022-12-01', end_date='2022-11-03')],
+        [
+            DateRangeDataFilter(end_date='2022-12-20'),
+            TeamsDataFilter(teams=['Team 2', 'Team 7']),
+            DateRangeDataFilter(start_date='2022-11-03'),
+        ],
+    ],
+)
+@pytest.mark.parametrize('is_sorted', [True, False])
+def test_apply_filters(filters: List[AnyDataFilter], is_sorted: bool) -> None:
+    table, _ = parse_atoms(io.BytesIO(generate_csv(2000, teams=10)))
+    df = atoms_to_df(table.sort_by(ATOMS_ORDER))
+    if not is_sorted:
+        df = df.sample(frac=1, random_state=0)
+
+    expected = df
+    for data_filter in filters:  # straightforward chained filtering
+        if isinstance(data_filter, TeamsDataFilter):
+            expected = expected[expected['team'].isin(data_filter.teams)] if data_filter.teams else expected
+        else:
+            if data_filter.start_date:
+                expected = expected[expected['date'] >= pd.Timestamp(data_filter.start_date)]
+            if data_filter.end_date:
+                expected = expected[expected['date'] <= pd.Timestamp(data_filter.end_date)]
+
+    assert apply_filters(df, filters, sorted_by_date=is_sorted).equals(expected)
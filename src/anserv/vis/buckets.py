@@ -0,0 +1,65 @@
+import datetime
+import enum
+
+import numpy as np
+import numpy.typing as npt
+from sqlalchemy import Date, DateTime, Interval, SQLColumnExpression, cast, func, literal_column
+
+
+class DateResolution(str, enum.Enum):
+    DAY = 'day'
+    WEEK = 'week'
+    MONTH = 'month'
+
+
+RES_TO_FREQ = {
+    DateResolution.DAY: 'D',
+    DateResolution.WEEK: 'W-MON',
+    DateResolution.MONTH: 'M',
+}
+
+# Resolutions materialized as rollups of entries, day buckets are atoms themselves
+ROLLUP_RESOLUTIONS = [DateResolution.WEEK, DateResolution.MONTH]
+
+
+def date_bucket(
+    date: SQLColumnExpression[datetime.date], resolution: DateResolution
+) -> SQLColumnExpression[datetime.date]:
+    """SQL equivalent of labels of `pd.Grouper(freq=RES_TO_FREQ[resolution])`"""
+    if resolution == DateResolution.DAY:
+        return date
+    if resolution == DateResolution.WEEK:
+        # 'W-MON' weeks end on Mondays and are labeled by them, so it's the Monday of a date six days later
+        return cast(func.date_trunc('week', cast(date + 6, DateTime)), Date)
+    if resolution == DateResolution.MONTH:
+        # 'M' months are labeled by their last days
+        month_end = literal_column("INTERVAL '1 month - 1 day'", Interval)
+        return cast(func.date_trunc('month', cast(date, DateTime)) + month_end, Date)
+    raise ValueError(f'Unknown date resolution: {resolution}')
+
+
+def bucket_labels(dates: npt.NDArray[np.datetime64], resolution: DateResolution) -> npt.NDArray[np.datetime64]:
+    """The same as `date_bucket` for an array of datetime64[D]"""
+    if resolution == DateResolution.DAY:
+        return dates
+    if resolution == DateResolution.WEEK:
+        days = dates.astype(np.int64)
+        weekdays = (days + 3) % 7  # Monday is 0, 1970-01-01 is Thursday
+        return (days + (7 - weekdays) % 7).astype('datetime64[D]')
+    if resolution == DateResolution.MONTH:
+        next_months = (dates.astype('datetime64[M]') + 1).astype('datetime64[D]')
+        return (next_months.astype(np.int64) - 1).astype('datetime64[D]')  # the day before the next month
+    raise ValueError(f'Unknown date resolution: {resolution}')
+
+
+def bucket_label(date: datetime.date, resolution: DateResolution) -> datetime.date:
+    label: datetime.date = bucket_labels(np.array([date], dtype='datetime64[D]'), resolution)[0].item()
+    return label
+
+
+def is_bucket_start(date: datetime.date, resolution: DateResolution) -> bool:
+    return bucket_label(date - datetime.timedelta(days=1), resolution) != bucket_label(date, resolution)
+
+
+def is_bucket_end(date: datetime.date, resolution: DateResolution) -> bool:
+    return bucket_label(date, resolution) == date
@@ -1,12 +1,18 @@
 import datetime
 import enum
 import typing
-from typing import List, Literal, Optional, Union
+from typing import List, Literal, Optional, Sequence, Tuple, Union
 
+import numpy as np
+import numpy.typing as npt
 import pandas as pd
 from pydantic import BaseModel, Field
+from sqlalchemy import ColumnElement, and_
 
 from const import Columns
+from db.orm import AtomOrm, RollupOrm
+
+from .buckets import DateResolution, bucket_label, is_bucket_end, is_bucket_start
 
 
 class DataFilterTypes(str, enum.Enum):
@@ -21,6 +27,27 @@ class BaseDataFilter(BaseModel):
         frozen = True
 
     def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        mask = self.mask(df)
+        return df if mask is None else df[mask]
+
+    def mask(self, df: pd.DataFrame) -> Optional[npt.NDArray[np.bool_]]:
+        """Rows of the frame matching the filter, None if the filter doesn't filter anything"""
+        raise NotImplementedError
+
+    def date_bounds(self) -> Tuple[Optional[datetime.date], Optional[datetime.date]]:
+        """Inclusive range of dates matching the filter, either end is None if it's open.
+
+        Raises NotImplementedError if the filter doesn't select rows by date only.
+        """
+        raise NotImplementedError
+
+    def where_clause(self, resolution: Optional[DateResolution] = None) -> Optional[ColumnElement[bool]]:
+        """Same condition for atoms in the database, or for rollups of the resolution if it's given.
+        None if the filter doesn't filter anything.
+
+        Raises NotImplementedError if the filter can't be pushed down to SQL,
+        or rollups can't be filtered the same way, e.g. a date range doesn't consist of whole buckets.
+        """
         raise NotImplementedError
 
 
@@ -29,10 +56,20 @@ class TeamsDataFilter(BaseDataFilter):
 
     teams: List[str] = Field(default_factory=list)
 
-    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+    def mask(self, df: pd.DataFrame) -> Optional[npt.NDArray[np.bool_]]:
+        if not self.teams:
+            return None
+        teams = df[Columns.TEAM.value]
+        if isinstance(teams.dtype, pd.CategoricalDtype):  # categories are looked up once, rows by their codes
+            matching: npt.NDArray[np.bool_] = np.isin(teams.cat.categories.to_numpy(), self.teams)
+            mask: npt.NDArray[np.bool_] = matching[teams.cat.codes.to_numpy()]
+            return mask
+        return teams.isin(self.teams).to_numpy()
+
+    def where_clause(self, resolution: Optional[DateResolution] = None) -> Optional[ColumnElement[bool]]:
         if not self.teams:
-            return df
-        return df[df[Columns.TEAM].isin(self.teams)]
+            return None
+        return (AtomOrm.team if resolution is None else RollupOrm.team).in_(self.teams)
 
 
 class DateRangeDataFilter(BaseDataFilter):
@@ -41,19 +78,100 @@ class DateRangeDataFilter(BaseDataFilter):
     start_date: Optional[datetime.date]
     end_date: Optional[datetime.date]
 
-    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+    def mask(self, df: pd.DataFrame) -> Optional[npt.NDArray[np.bool_]]:
+        if not self.start_date and not self.end_date:
+            return None
+        dates = df[Columns.DATE.value].to_numpy()
+        mask = np.ones(len(dates), dtype=np.bool_)
         if self.start_date:
-            d = datetime.datetime.combine(self.start_date, datetime.time())
-            df = df[df[Columns.DATE] >= d]
+            mask &= dates >= np.datetime64(self.start_date)
         if self.end_date:
-            d = datetime.datetime.combine(self.end_date, datetime.time())
-            df = df[df[Columns.DATE] <= d]
-        return df
+            mask &= dates <= np.datetime64(self.end_date)
+        return mask
+
+    def date_bounds(self) -> Tuple[Optional[datetime.date], Optional[datetime.date]]:
+        return self.start_date, self.end_date
+
+    def where_clause(self, resolution: Optional[DateResolution] = None) -> Optional[ColumnElement[bool]]:
+        clauses = []
+        if resolution is None:
+            if self.start_date:
+                clauses.append(AtomOrm.date >= self.start_date)
+            if self.end_date:
+                clauses.append(AtomOrm.date <= self.end_date)
+        else:  # only whole buckets can be selected by their labels
+            if self.start_date:
+                if not is_bucket_start(self.start_date, resolution):
+                    raise NotImplementedError
+                clauses.append(RollupOrm.date >= bucket_label(self.start_date, resolution))
+            if self.end_date:
+                if not is_bucket_end(self.end_date, resolution):
+                    raise NotImplementedError
+                clauses.append(RollupOrm.date <= self.end_date)
+        return and_(*clauses) if clauses else None
 
 
 AnyDataFilter = Union[TeamsDataFilter, DateRangeDataFilter]
 
 
+def compile_filters(
+    filters: Sequence[AnyDataFilter], resolution: Optional[DateResolution] = None
+) -> Tuple[List[ColumnElement[bool]], List[AnyDataFilter]]:
+    """WHERE clauses of filters which can be pushed down to SQL, along with the rest of filters.
+
+    Clauses are for atoms, or for rollups of the resolution if it's given.
+    """
+    where = []
+    rest = []
+    for data_filter in filters:
+        try:
+            clause = data_filter.where_clause(resolution)
+        except NotImplementedError:
+            rest.append(data_filter)
+        else:
+            if clause is not None:
+                where.append(clause)
+    return where, rest
+
+
+def apply_filters(df: pd.DataFrame, filters: Sequence[AnyDataFilter], sorted_by_date: bool = False) -> pd.DataFrame:
+    """Rows of the frame matching all filters, only they are copied, at most once.
+
+    If the caller knows the frame is sorted by date, e.g. it's returned by `api.services.df_for_entry`,
+    date ranges are a slice of rows found by binary search. Other filters are evaluated on that slice only
+    and combined into a single mask.
+    """
+    if not filters:
+        return df
+
+    dates = df[Columns.DATE.value].to_numpy()
+    start, stop = 0, len(df)
+    rest = []
+    for data_filter in filters:
+        try:
+            start_date, end_date = data_filter.date_bounds()
+        except NotImplementedError:
+            rest.append(data_filter)
+            continue
+        if not sorted_by_date:
+            rest.append(data_filter)
+            continue
+        if start_date:
+            start = max(start, int(np.searchsorted(dates, np.datetime64(start_date), side='left')))
+        if end_date:
+            stop = min(stop, int(np.searchsorted(dates, np.datetime64(end_date), side='right')))
+
+    if (start, stop) != (0, len(df)):
+        df = df.iloc[start : max(start, stop)]  # a view, not a copy
+
+    mask: Optional[npt.NDArray[np.bool_]] = None
+    for data_filter in rest:
+        filter_mask = data_filter.mask(df)
+        if filter_mask is not None:
+            mask = filter_mask if mask is None else mask & filter_mask
+    return df if mask is None else df[mask]
+
+
 # check that all data filter types has relevant model
 assert all(c.__fields__['filter_type'].default in DataFilterTypes for c in typing.get_args(AnyDataFilter))
 assert len(DataFilterTypes) == len(typing.get_args(AnyDataFilter))
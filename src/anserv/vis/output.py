@@ -25,10 +25,19 @@ class ReviewOverMergeOutputEntry(BaseOutputEntry):
     date: datetime.date
 
 
+class ReviewOverMergeGridOutputEntry(ReviewOverMergeOutputEntry):
+    """Grid cell of downsampled atoms, see `ReviewOverMergeVis.sampling`"""
+
+    count: int  # number of atoms of the cell
+
+
 class ReviewMergeRatioOutputEntry(BaseOutputEntry):
     value: int
     type: MeasureTypes
     team: str
 
 
-AnyOutputEntry = Union[DateByTypeOutputEntry, ReviewOverMergeOutputEntry, ReviewMergeRatioOutputEntry]
+# Grid cells go before atoms, otherwise they would be parsed as atoms without counts
+AnyOutputEntry = Union[
+    DateByTypeOutputEntry, ReviewOverMergeGridOutputEntry, ReviewOverMergeOutputEntry, ReviewMergeRatioOutputEntry
+]
@@ -0,0 +1,117 @@
+import enum
+import math
+from typing import Any, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from const import Columns
+
+
+class SamplingStrategies(str, enum.Enum):
+    UNIFORM = 'uniform'  # random atoms
+    STRATIFIED = 'stratified'  # random atoms, split between teams as evenly as their sizes allow
+    GRID = 'grid'  # one point per non-empty cell of a grid over both measures, for each team
+
+
+# Samples are the same for the same atoms, so outputs are reproducible and cacheable
+SAMPLING_SEED = 0
+
+
+def _team_codes(df: pd.DataFrame) -> Tuple[npt.NDArray[np.int64], 'pd.Index[Any]']:
+    teams = df[Columns.TEAM.value]
+    if not isinstance(teams.dtype, pd.CategoricalDtype):
+        teams = teams.astype('category')
+    return teams.cat.codes.to_numpy().astype(np.int64), teams.cat.categories
+
+
+def sample_uniform(df: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    """At most `max_points` random rows, in their original order"""
+    if len(df) <= max_points:
+        return df
+    rng = np.random.default_rng(SAMPLING_SEED)
+    return df.iloc[np.sort(rng.choice(len(df), max_points, replace=False))]
+
+
+def sample_stratified(df: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    """At most `max_points` random rows, in their original order.
+
+    Every team gets the same quota, teams with fewer rows are taken whole and the rest of their quota goes
+    to the larger ones, so small teams are not lost in the sample. Points left after equal quotas go to random
+    teams, a row to each, so with more teams than points some of them are not sampled.
+    """
+    if len(df) <= max_points:
+        return df
+
+    codes, categories = _team_codes(df)
+    sizes = np.bincount(codes, minlength=len(categories))
+    # the largest quota which fits, sum of sizes capped by it only grows with the quota
+    lo, hi = 0, int(sizes.max())
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if np.minimum(sizes, mid).sum() <= max_points:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    # random order within each team, rows with a rank below the quota are taken
+    rng = np.random.default_rng(SAMPLING_SEED)
+    order = np.argsort(codes + rng.random(len(df)))  # fractional parts shuffle rows of a team
+    starts = np.cumsum(sizes) - sizes
+    ranks = np.empty(len(df), dtype=np.int64)
+    ranks[order] = np.arange(len(df)) - np.repeat(starts, sizes)
+    mask: npt.NDArray[np.bool_] = ranks < lo
+    left = max_points - int(np.minimum(sizes, lo).sum())
+    mask[rng.permutation(np.flatnonzero(ranks == lo))[:left]] = True
+    return df[mask]
+
+
+def grid_bins(df: pd.DataFrame, max_points: int) -> pd.DataFrame:
+    """Rows aggregated by team and a cell of a square grid over merge and review times, ordered by them.
+
+    The grid is the same for all teams and has as many cells as fit in `max_points` for every team,
+    but at least one. With more teams than `max_points`, only the cells with the most rows are kept.
+    Measures of a cell are means of its rows rounded to integers, its date is the latest one,
+    `count` is a number of its rows.
+    """
+    codes, categories = _team_codes(df)
+    if not len(codes):
+        return df.assign(count=np.zeros(0, dtype=np.int64))
+    side = max(math.isqrt(max_points // len(np.unique(codes))), 1)
+
+    key = codes
+    for col in (Columns.MERGE_TIME, Columns.REVIEW_TIME):
+        values = df[col.value].to_numpy().astype(np.int64)
+        lo = values.min()
+        span = values.max() - lo + 1
+        key = key * side + (values - lo) * side // span
+
+    grouped = pd.DataFrame(
+        {
+            'key': key,
+            Columns.MERGE_TIME.value: df[Columns.MERGE_TIME.value].to_numpy(),
+            Columns.REVIEW_TIME.value: df[Columns.REVIEW_TIME.value].to_numpy(),
+            Columns.DATE.value: df[Columns.DATE.value].to_numpy(),
+        }
+    ).groupby('key', sort=True)
+    cells = grouped.agg(
+        merge_time=(Columns.MERGE_TIME.value, 'mean'),
+        review_time=(Columns.REVIEW_TIME.value, 'mean'),
+        date=(Columns.DATE.value, 'max'),
+        count=(Columns.DATE.value, 'size'),
+    )
+    if len(cells) > max_points:
+        cells = cells.iloc[np.sort(np.argsort(-cells['count'].to_numpy(), kind='stable')[:max_points])]
+    cell_keys = cells.index.to_numpy()
+    return pd.DataFrame(
+        {
+            Columns.MERGE_TIME.value: cells[Columns.MERGE_TIME.value].round().to_numpy().astype(np.int64),
+            Columns.REVIEW_TIME.value: cells[Columns.REVIEW_TIME.value].round().to_numpy().astype(np.int64),
+            Columns.TEAM.value: pd.Categorical.from_codes(
+                (cell_keys // (side * side)).tolist(), categories=categories
+            ),
+            Columns.DATE.value: cells[Columns.DATE.value].to_numpy(),
+            'count': cells['count'].to_numpy().astype(np.int64),
+        }
+    )
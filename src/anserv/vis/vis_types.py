@@ -1,15 +1,25 @@
-import enum
 import typing
-from typing import ClassVar, List, Literal, Union
+from typing import ClassVar, List, Literal, Optional, Sequence, Union
 
+import numpy as np
 import pandas as pd
 from pydantic import BaseModel, Field, validator
+from sqlalchemy import BigInteger, ColumnElement, Select, SQLColumnExpression, func, select
 from typing_extensions import Annotated, Type
 
 from const import MT2COL, ChartTypes, Columns, MeasureTypes, VisTypes
+from db.orm import AtomOrm, RollupOrm
 
-from .filters import AnyDataFilter
-from .output import AnyOutputEntry, DateByTypeOutputEntry, ReviewMergeRatioOutputEntry, ReviewOverMergeOutputEntry
+from .buckets import RES_TO_FREQ, ROLLUP_RESOLUTIONS, DateResolution, date_bucket
+from .filters import AnyDataFilter, apply_filters
+from .output import (
+    AnyOutputEntry,
+    DateByTypeOutputEntry,
+    ReviewMergeRatioOutputEntry,
+    ReviewOverMergeGridOutputEntry,
+    ReviewOverMergeOutputEntry,
+)
+from .sampling import SamplingStrategies, grid_bins, sample_stratified, sample_uniform
 
 
 class BaseVis(BaseModel):
@@ -29,29 +39,136 @@ class BaseVis(BaseModel):
             raise ValueError('Specified chart type is not allowed')
         return v
 
-    def apply(self, df: pd.DataFrame) -> List[AnyOutputEntry]:
-        for filter in self.filters:
-            df = filter.apply(df)
+    @property
+    def entry_format(self) -> Type[AnyOutputEntry]:
+        """Output entries of these options, `output_format` or a subclass of it"""
+        return self.output_format
 
-        out = self.make_output(df)
-        assert not out or isinstance(out[0], self.output_format)
+    def apply(self, df: pd.DataFrame, sorted_by_date: bool = False) -> List[AnyOutputEntry]:
+        """Output made of atoms, see `apply_filters` for `sorted_by_date`"""
+        out = self.make_output(apply_filters(df, self.filters, sorted_by_date))
+        assert not out or isinstance(out[0], self.entry_format)
         return out
 
+    def aggregation(self) -> Optional['Aggregation']:
+        """Aggregation of atoms the output is made of, None if the output needs atoms themselves"""
+        return None
+
+    def apply_aggregated(self, aggregated: pd.DataFrame) -> List[AnyOutputEntry]:
+        """Output made of atoms which were already filtered and aggregated elsewhere, e.g. by the database"""
+        out = self.make_aggregated_output(aggregated)
+        assert not out or isinstance(out[0], self.entry_format)
+        return out
+
+    def apply_frame(self, df: pd.DataFrame, sorted_by_date: bool = False) -> pd.DataFrame:
+        """The same output as `apply`, but as a frame, see `make_frame`"""
+        return self._check_frame(self.make_frame(apply_filters(df, self.filters, sorted_by_date)))
+
+    def apply_aggregated_frame(self, aggregated: pd.DataFrame) -> pd.DataFrame:
+        """The same output as `apply_aggregated`, but as a frame, see `make_frame`"""
+        return self._check_frame(self.make_aggregated_frame(aggregated))
+
     def make_output(self, df: pd.DataFrame) -> List[AnyOutputEntry]:
+        """Output entries built from `make_frame`, its values are valid already, so entries are not validated again"""
+        records = frame_records(self._check_frame(self.make_frame(df)))
+        return [self.entry_format.construct(**record) for record in records]
+
+    def make_aggregated_output(self, aggregated: pd.DataFrame) -> List[AnyOutputEntry]:
+        """The same as `make_output`, but from `make_aggregated_frame`"""
+        records = frame_records(self._check_frame(self.make_aggregated_frame(aggregated)))
+        return [self.entry_format.construct(**record) for record in records]
+
+    def make_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Output entries as a frame with a column per field of `entry_format`, built with column operations only.
+
+        Dates are datetime64, teams and measure types are categorical.
+        """
+        aggregation = self.aggregation()
+        if aggregation is None:
+            raise NotImplementedError
+        return self.make_aggregated_frame(aggregation.apply(df))
+
+    def make_aggregated_frame(self, aggregated: pd.DataFrame) -> pd.DataFrame:
         raise NotImplementedError
 
+    def _check_frame(self, frame: pd.DataFrame) -> pd.DataFrame:
+        assert list(frame.columns) == list(self.entry_format.__fields__)
+        return frame
+
+
+def frame_records(frame: pd.DataFrame) -> List[typing.Dict[str, typing.Any]]:
+    """Rows of an output frame as dicts of python values, each column is converted at once.
+
+    Dates become `datetime.date`, categorical values are their categories.
+    """
+    columns: List[List[typing.Any]] = []
+    for _, col in frame.items():
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            columns.append(col.cat.categories.to_numpy(dtype=object)[col.cat.codes.to_numpy()].tolist())
+        elif pd.api.types.is_datetime64_dtype(col.dtype):
+            columns.append(col.to_numpy().astype('datetime64[D]').tolist())
+        else:
+            columns.append(col.tolist())
+    names = [str(name) for name in frame.columns]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def melt_measures(aggregated: pd.DataFrame) -> pd.DataFrame:
+    """Aggregated frame as rows of (*index, value, type) for each measure type, measure types go one after another"""
+    index = aggregated.index.to_frame(index=False)
+    frame = pd.concat([index] * len(MeasureTypes), ignore_index=True)
+    frame['value'] = np.concatenate([aggregated[MT2COL[mt]].to_numpy() for mt in MeasureTypes])
+    codes = np.repeat(np.arange(len(MeasureTypes)), len(aggregated))
+    frame['type'] = pd.Categorical.from_codes(
+        typing.cast(Sequence[int], codes), dtype=pd.CategoricalDtype(list(MeasureTypes))
+    )
+    if not isinstance(frame[Columns.TEAM].dtype, pd.CategoricalDtype):  # aggregated by the database
+        frame[Columns.TEAM] = frame[Columns.TEAM].astype('category')
+    return frame
 
-class DateResolution(str, enum.Enum):
-    DAY = 'day'
-    WEEK = 'week'
-    MONTH = 'month'
 
+class Aggregation(BaseModel):
+    """Sums of measures by team and, optionally, by date buckets.
 
-RES_TO_FREQ = {
-    DateResolution.DAY: 'D',
-    DateResolution.WEEK: 'W-MON',
-    DateResolution.MONTH: 'M',
-}
+    Aggregated frame is indexed by team or by (date, team), ordered by index, with a column for each measure.
+    It's small enough to be calculated by the database, pandas implementation is the reference one.
+    """
+
+    date_resolution: Optional[DateResolution] = None
+
+    class Config:
+        frozen = True
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        keys: List[Union[pd.Grouper, str]] = [Columns.TEAM.value]
+        if self.date_resolution is not None:
+            keys.insert(0, pd.Grouper(key=Columns.DATE.value, freq=RES_TO_FREQ[self.date_resolution]))
+        grouped = df.groupby(keys, observed=True)[list(MT2COL.values())].sum()
+        return grouped.sort_index()  # observed groups of categorical teams are in order of appearance
+
+    def query(self, where: Sequence[ColumnElement[bool]]) -> Select[typing.Any]:
+        """The same aggregation of atoms matching `where` clauses, rows are not ordered"""
+        keys: List[SQLColumnExpression[typing.Any]] = [AtomOrm.team.label(Columns.TEAM.value)]
+        if self.date_resolution is not None:
+            keys.insert(0, date_bucket(AtomOrm.date, self.date_resolution).label(Columns.DATE.value))
+        measures = [func.sum(getattr(AtomOrm, col.value)).label(col.value) for col in MT2COL.values()]
+        return select(*keys, *measures).where(*where).group_by(*keys)
+
+    def rollup_resolutions(self) -> List[DateResolution]:
+        """Resolutions of rollups the aggregation can be made of, the coarsest first"""
+        if self.date_resolution is None:
+            return ROLLUP_RESOLUTIONS[::-1]
+        return [self.date_resolution] if self.date_resolution in ROLLUP_RESOLUTIONS else []
+
+    def rollup_query(self, resolution: DateResolution, where: Sequence[ColumnElement[bool]]) -> Select[typing.Any]:
+        """The same as `query`, but made of rollups of the resolution matching `where` clauses"""
+        keys: List[SQLColumnExpression[typing.Any]] = [RollupOrm.team.label(Columns.TEAM.value)]
+        if self.date_resolution is not None:
+            keys.insert(0, RollupOrm.date.label(Columns.DATE.value))
+        measures = [  # sums of bigint are numeric
+            func.sum(getattr(RollupOrm, col.value)).cast(BigInteger).label(col.value) for col in MT2COL.values()
+        ]
+        return select(*keys, *measures).where(RollupOrm.resolution == resolution.value, *where).group_by(*keys)
 
 
 class DateByTypeVis(BaseVis):
@@ -61,26 +178,11 @@ class DateByTypeVis(BaseVis):
     vis_type: Literal[VisTypes.DATE_BY_TYPE] = VisTypes.DATE_BY_TYPE
     date_resolution: DateResolution
 
-    def make_output(self, df: pd.DataFrame) -> List[DateByTypeOutputEntry]:  # type: ignore[override]
-        out = []
-
-        freq = RES_TO_FREQ[self.date_resolution]
-        grouped = df.groupby([pd.Grouper(key=Columns.DATE, freq=freq), Columns.TEAM]).sum()
-
-        for mt in MeasureTypes:
-            for indexes, value in grouped[MT2COL[mt]].items():
-                assert isinstance(indexes, tuple)  # typing
-                idate, team = indexes
-                out.append(
-                    DateByTypeOutputEntry(
-                        date=idate.date(),
-                        value=value,
-                        type=mt,
-                        team=team,
-                    )
-                )
+    def aggregation(self) -> Aggregation:
+        return Aggregation(date_resolution=self.date_resolution)
 
-        return out
+    def make_aggregated_frame(self, grouped: pd.DataFrame) -> pd.DataFrame:
+        return melt_measures(grouped)[list(self.output_format.__fields__)]
 
 
 class ReviewOverMergeVis(BaseVis):
@@ -88,19 +190,37 @@ class ReviewOverMergeVis(BaseVis):
     output_format = ReviewOverMergeOutputEntry
 
     vis_type: Literal[VisTypes.REVIEW_OVER_MERGE] = VisTypes.REVIEW_OVER_MERGE
-
-    def make_output(self, df: pd.DataFrame) -> List[ReviewOverMergeOutputEntry]:  # type: ignore[override]
-        out = []
-        for _, row in df.iterrows():
-            out.append(
-                ReviewOverMergeOutputEntry(
-                    merge_value=row[Columns.MERGE_TIME],
-                    review_value=row[Columns.REVIEW_TIME],
-                    team=row[Columns.TEAM],
-                    date=row[Columns.DATE],
-                )
-            )
-        return out
+    max_points: Optional[int] = Field(None, gt=0, description='Atoms are downsampled if there are more of them')
+    sampling: SamplingStrategies = SamplingStrategies.UNIFORM
+
+    @property
+    def entry_format(self) -> Type[AnyOutputEntry]:
+        """Grid cells have counts of atoms, even if there are too few atoms to bin them, atoms have none"""
+        return ReviewOverMergeGridOutputEntry if self.sampling == SamplingStrategies.GRID else self.output_format
+
+    def make_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        df = self.downsample(df)
+        frame = pd.DataFrame(
+            {
+                'merge_value': df[Columns.MERGE_TIME],
+                'review_value': df[Columns.REVIEW_TIME],
+                'team': df[Columns.TEAM],
+                'date': df[Columns.DATE],
+            }
+        )
+        if self.sampling == SamplingStrategies.GRID:
+            frame['count'] = df['count'] if 'count' in df else 1
+        return frame
+
+    def downsample(self, df: pd.DataFrame) -> pd.DataFrame:
+        """At most `max_points` atoms, or grid cells with their counts, picked by the sampling strategy"""
+        if self.max_points is None or len(df) <= self.max_points:
+            return df
+        if self.sampling == SamplingStrategies.STRATIFIED:
+            return sample_stratified(df, self.max_points)
+        if self.sampling == SamplingStrategies.GRID:
+            return grid_bins(df, self.max_points)
+        return sample_uniform(df, self.max_points)
 
 
 class ReviewMergeRatioVis(BaseVis):
@@ -109,22 +229,11 @@ class ReviewMergeRatioVis(BaseVis):
 
     vis_type: Literal[VisTypes.REVIEW_MERGE_RATIO] = VisTypes.REVIEW_MERGE_RATIO
 
-    def make_output(self, df: pd.DataFrame) -> List[ReviewMergeRatioOutputEntry]:  # type: ignore[override]
-        out = []
-
-        grouped = df.groupby(Columns.TEAM).sum()  # FIXME: pandas deprecation
-
-        for mt in MeasureTypes:
-            for team, value in grouped[MT2COL[mt]].items():
-                assert isinstance(team, str)  # typing
-                out.append(
-                    ReviewMergeRatioOutputEntry(
-                        team=team,
-                        type=mt,
-                        value=value,
-                    )
-                )
-        return out
+    def aggregation(self) -> Aggregation:
+        return Aggregation()
+
+    def make_aggregated_frame(self, grouped: pd.DataFrame) -> pd.DataFrame:
+        return melt_measures(grouped)[list(self.output_format.__fields__)]
 
 
 AnyVisType = Union[DateByTypeVis, ReviewOverMergeVis, ReviewMergeRatioVis]